@@ -0,0 +1,109 @@
+"""
+Compare AsyncCSVReader with the line-at-a-time AsyncDictReader it replaced
+
+    python benchmarks/async_csv_reader.py --rows 200000
+"""
+
+from csv import DictReader
+from datasette_app_support.utils import AsyncCSVReader
+import argparse
+import asyncio
+import io
+import time
+
+
+class AsyncDictReader:
+    # The previous implementation, kept here for comparison
+    def __init__(self, async_line_iterator):
+        self.async_line_iterator = async_line_iterator
+        self.buffer = io.StringIO()
+        self.reader = DictReader(self.buffer)
+        self.line_num = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.line_num == 0:
+            header = await self.async_line_iterator.__anext__()
+            self.buffer.write(header)
+
+        line = await self.async_line_iterator.__anext__()
+
+        if not line:
+            raise StopAsyncIteration
+
+        self.buffer.write(line)
+        self.buffer.seek(0)
+
+        try:
+            result = next(self.reader)
+        except StopIteration as e:
+            raise StopAsyncIteration from e
+
+        self.buffer.seek(0)
+        self.buffer.truncate(0)
+        self.line_num = self.reader.line_num
+
+        return result
+
+
+def make_csv(num_rows):
+    lines = ["id,name,description,latitude,longitude\n"]
+    for i in range(num_rows):
+        lines.append(
+            '{},Name {},"A description, with a comma",{},{}\n'.format(
+                i, i, 37.0 + i / num_rows, -122.0 - i / num_rows
+            )
+        )
+    return "".join(lines).encode("utf-8")
+
+
+async def byte_chunks(data, chunk_size):
+    for i in range(0, len(data), chunk_size):
+        yield data[i : i + chunk_size]
+
+
+async def text_lines(data):
+    # Simulates httpx's aiter_lines(), which decodes and splits the body
+    for line in data.decode("utf-8").splitlines(keepends=True):
+        yield line
+    yield ""
+
+
+async def run_old(data):
+    count = 0
+    async for _ in AsyncDictReader(text_lines(data)):
+        count += 1
+    return count
+
+
+async def run_new(data, chunk_size):
+    count = 0
+    async for rows in AsyncCSVReader(byte_chunks(data, chunk_size)):
+        count += len(rows)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--chunk-size", type=int, default=65536)
+    args = parser.parse_args()
+    data = make_csv(args.rows)
+    print("{:,} rows, {:,} bytes".format(args.rows, len(data)))
+    for name, coro in (
+        ("AsyncDictReader", lambda: run_old(data)),
+        ("AsyncCSVReader", lambda: run_new(data, args.chunk_size)),
+    ):
+        start = time.perf_counter()
+        count = asyncio.run(coro())
+        elapsed = time.perf_counter() - start
+        assert count == args.rows, (name, count)
+        print(
+            "{:<16} {:.3f}s  {:>12,.0f} rows/sec".format(name, elapsed, count / elapsed)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,51 @@
-from datasette.database import Database
 from datasette.utils.asgi import Response, Forbidden
 from datasette.utils import sqlite3
 from datasette import hookimpl
-from dateutil import parser
-from packaging import version
-from sqlite_utils.utils import rows_from_file
-import httpx
+import asyncio
+import functools
 import json
 import os
 import pathlib
 import secrets
-import sqlite_utils
-from .utils import derive_table_name, import_csv_url_to_database
+from .charsets import encoding_from_body
+from .databases import (
+    PROFILES,
+    add_profiled_database,
+    apply_connection_pragmas,
+    attach_database_files,
+    create_database_file,
+    creation_options_from_body,
+    database_profiles,
+    path_registry,
+    profile_from_body,
+)
+from .dates import prettydate
+from .importer import (
+    ImportProgress,
+    batch_size_from_body,
+    import_csv_file_to_database,
+    import_csv_files_to_database,
+    import_options_from_body,
+)
+from .jobs import import_jobs, start_import_job
+from .plugin_directory import setup_plugin_directory
+from .template_vars import template_vars
+from .temporary import (
+    add_temporary_database,
+    attach_snapshot,
+    dump_temporary,
+    prepare_temporary_connection,
+    restore_temporary,
+    schedule_autosave,
+)
+from .utils import (
+    import_csv_url_to_database,
+    release_table_names,
+    reserve_table_name,
+    table_name_from_filepath,
+    table_name_from_url,
+    url_import_state,
+)
 
 
 @hookimpl
@@ -20,79 +54,23 @@ def startup(datasette):
         if getattr(datasette, "_app_support_initialized", False):
             return
         datasette._app_support_initialized = True
-        try:
-            plugins = httpx.get(
-                "https://datasette.io/content/plugins.json?_shape=array&_size=max"
-            ).json()
-        except httpx.HTTPError:
-            plugins = []
-        # Annotate with list of installed plugins
-        installed_plugins = {
-            plugin["name"]: plugin["version"]
-            for plugin in (await datasette.client.get("/-/plugins.json")).json()
-        }
-        default_plugins = (os.environ.get("DATASETTE_DEFAULT_PLUGINS") or "").split()
-        for plugin in plugins:
-            is_installed = plugin["name"] in installed_plugins
-            installed_version = installed_plugins.get(plugin["name"])
-            plugin["installed"] = "installed" if is_installed else "not installed"
-            plugin["installed_version"] = installed_version
-            plugin["upgrade"] = (
-                "upgrade available"
-                if (
-                    is_installed
-                    and installed_version
-                    and (
-                        version.parse(installed_version)
-                        < version.parse(plugin.get("tag_name", ""))
-                    )
-                )
-                else None
-            )
-            plugin["is_default"] = plugin["name"] in default_plugins
         try:
             datasette.remove_database("_memory")
         except KeyError:
             pass
-        datasette.add_memory_database("temporary")
-        plugin_directory_db = datasette.add_memory_database("plugin_directory")
-
-        def write_plugins(conn):
-            db = sqlite_utils.Database(conn)
-            for table in ("plugins", "plugins_fts"):
-                db[table].drop(ignore=True)
-            if plugins:
-                db["plugins"].insert_all(plugins, pk="full_name")
-                db["plugins"].enable_fts(["full_name", "name", "description"])
-            else:
-                # Create an empty table
-                db["plugins"].create(
-                    {
-                        "name": str,
-                        "full_name": str,
-                        "owner": str,
-                        "description": str,
-                        "stargazers_count": int,
-                        "tag_name": str,
-                        "latest_release_at": str,
-                        "created_at": str,
-                        "openGraphImageUrl": str,
-                        "usesCustomOpenGraphImage": int,
-                        "downloads_this_week": int,
-                        "is_plugin": int,
-                        "is_tool": int,
-                        "installed": str,
-                        "installed_version": str,
-                        "upgrade": str,
-                        "is_default": int,
-                    }
-                )
-
-        await plugin_directory_db.execute_write_fn(write_plugins, block=True)
+        add_temporary_database(datasette)
+        await setup_plugin_directory(datasette)
 
     return inner
 
 
+@hookimpl
+def prepare_connection(conn, database, datasette):
+    if database == "temporary":
+        prepare_temporary_connection(conn, datasette)
+    apply_connection_pragmas(conn, database, datasette)
+
+
 @hookimpl
 def permission_allowed(actor, action, resource):
     # Block access to _internal even for the "root" actor
@@ -127,49 +105,101 @@ async def open_database_file(request, datasette):
     if not check_auth(request):
         return unauthorized
     try:
-        filepath = await _filepath_from_json_body(request)
+        filepath, body = await _filepath_from_json_body(request, return_data=True)
+        profile = profile_from_body(body)
     except PathError as e:
         return error(e.message)
-    # Confirm it's a valid SQLite database
-    conn = sqlite3.connect(filepath)
+    except ValueError as e:
+        return error(str(e))
+    result = (await attach_database_files(datasette, [filepath], profile))[0]
+    if not result["ok"]:
+        return error(result["error"])
+    return Response.json(
+        {"ok": True, "path": result["path"], "file_info": result["file_info"]}
+    )
+
+
+async def open_database_files(request, datasette):
+    if not check_auth(request):
+        return unauthorized
+    body = await request.post_body()
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return error("Invalid request body, should be JSON")
+    paths = data.get("paths")
+    directory = data.get("directory")
+    if paths is not None:
+        if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+            return error("'paths' must be a list of strings")
+    elif directory:
+        if not os.path.isdir(directory):
+            return error("'directory' does not exist")
+        paths = sorted(
+            str(p)
+            for p in pathlib.Path(directory).glob(data.get("glob") or "*.db")
+            if p.is_file()
+        )
+    else:
+        return error("'paths' or 'directory' key is required")
     try:
-        conn.execute("select * from sqlite_master")
-    except sqlite3.DatabaseError:
-        return error("Not a valid SQLite database")
-    # Is that file already open?
-    existing_paths = {
-        pathlib.Path(db.path).resolve()
-        for db in datasette.databases.values()
-        if db.path
-    }
-    if pathlib.Path(filepath).resolve() in existing_paths:
-        return error("That file is already open")
-    added_db = datasette.add_database(
-        Database(datasette, path=filepath, is_mutable=True)
+        profile = profile_from_body(data)
+    except ValueError as e:
+        return error(str(e))
+    return Response.json(
+        {
+            "ok": True,
+            "databases": await attach_database_files(datasette, paths, profile),
+        }
     )
-    return Response.json({"ok": True, "path": datasette.urls.database(added_db.name)})
 
 
 async def new_empty_database_file(request, datasette):
     if not check_auth(request):
         return unauthorized
     try:
-        filepath = await _filepath_from_json_body(request, must_exist=False)
+        filepath, body = await _filepath_from_json_body(
+            request, must_exist=False, return_data=True
+        )
+        profile = profile_from_body(body)
+        options = creation_options_from_body(body)
     except PathError as e:
         return error(e.message)
+    except ValueError as e:
+        return error(str(e))
     # File should not exist yet
     if os.path.exists(filepath):
         return error("That file already exists")
 
-    conn = sqlite3.connect(filepath)
-    conn.execute("vacuum")
+    try:
+        await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(create_database_file, filepath, **options)
+        )
+    except sqlite3.Error as e:
+        return error("Could not create database: {}".format(e))
 
-    added_db = datasette.add_database(
-        Database(datasette, path=filepath, is_mutable=True)
-    )
+    added_db = await add_profiled_database(datasette, filepath, profile)
     return Response.json({"ok": True, "path": datasette.urls.database(added_db.name)})
 
 
+async def database_profiles_view(request, datasette):
+    if not check_auth(request):
+        return unauthorized
+    return Response.json(
+        {
+            "ok": True,
+            "profiles": PROFILES,
+            "databases": database_profiles(datasette),
+        }
+    )
+
+
+async def open_database_paths(request, datasette):
+    if not check_auth(request):
+        return unauthorized
+    return Response.json({"ok": True, "databases": path_registry(datasette).as_list()})
+
+
 class PathError(Exception):
     def __init__(self, message):
         self.message = message
@@ -209,19 +239,41 @@ async def open_csv_from_url(request, datasette):
     if database and (database not in datasette.databases):
         return error("Invalid database")
     db = datasette.get_database(database)
-    requested_table_name = data.get("table_name")
     try:
-        table_name, num_rows = await import_csv_url_to_database(
-            url, db, requested_table_name
-        )
-    except Exception as e:
-        return error(str(e), status=500)
-    return Response.json(
-        {
-            "ok": True,
-            "path": datasette.urls.table(db.name, table_name),
-            "rows": num_rows,
-        }
+        encoding = encoding_from_body(data)
+    except ValueError as e:
+        return error(str(e))
+    table_name = data.get("table_name")
+    if not table_name:
+        # Importing the same URL again reuses the table it was imported into
+        state = await url_import_state(db, url)
+        table_name = state["table_name"] if state else None
+    reserved = []
+    if not table_name:
+        table_name = await reserve_table_name(db, table_name_from_url(url))
+        reserved.append(table_name)
+
+    async def run(progress):
+        try:
+            _, num_rows = await import_csv_url_to_database(
+                url,
+                db,
+                table_name,
+                progress=progress,
+                resume=data.get("resume") is not False,
+                encoding=encoding,
+                **import_options_from_body(data)
+            )
+        finally:
+            release_table_names(db, *reserved)
+        return {"rows": num_rows}
+
+    return await _run_job(
+        datasette,
+        data,
+        datasette.urls.table(db.name, table_name),
+        run,
+        throughput=True,
     )
 
 
@@ -244,26 +296,154 @@ async def _import_csv_file(request, datasette, database=None):
 
     db = datasette.get_database(database)
 
-    table_name = await derive_table_name(db, pathlib.Path(filepath).stem)
-
     try:
-        rows = rows_from_file(open(filepath, "rb"))[0]
+        batch_size = batch_size_from_body(body)
+        encoding = encoding_from_body(body)
+    except ValueError as e:
+        return error(str(e))
 
-        def write_rows(conn):
-            dbconn = sqlite_utils.Database(conn)
-            dbconn[table_name].insert_all(rows)
-            return dbconn[table_name].count
+    table_name = await reserve_table_name(db, table_name_from_filepath(filepath))
 
-        num_rows = await db.execute_write_fn(write_rows, block=True)
+    async def run(progress):
+        try:
+            num_rows = await import_csv_file_to_database(
+                filepath,
+                db,
+                table_name,
+                batch_size=batch_size,
+                progress=progress,
+                encoding=encoding,
+                **import_options_from_body(body)
+            )
+        finally:
+            release_table_names(db, table_name)
+        return {"rows": num_rows}
+
+    return await _run_job(
+        datasette,
+        body,
+        datasette.urls.table(database, table_name),
+        run,
+        throughput=True,
+    )
+
+
+async def import_csv_files(request, datasette):
+    if not check_auth(request):
+        return unauthorized
+    body = await request.post_body()
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return error("Invalid request body, should be JSON")
+    paths = data.get("paths")
+    if (
+        not paths
+        or not isinstance(paths, list)
+        or not all(isinstance(p, str) for p in paths)
+    ):
+        return error("'paths' must be a list of strings")
+    for path in paths:
+        if not os.path.isfile(path):
+            return error("File does not exist: {}".format(path))
+    database = data.get("database")
+    if not database or database not in datasette.databases:
+        return error("Invalid database")
+    db = datasette.get_database(database)
+    try:
+        batch_size = batch_size_from_body(data)
+        encoding = encoding_from_body(data)
+    except ValueError as e:
+        return error(str(e))
+
+    table = data.get("table")
+    if table is not None and (not isinstance(table, str) or not table):
+        return error("'table' must be a string")
+    if table:
+        # Append every file to the same table
+        table_names = [table] * len(paths)
+        path = datasette.urls.table(database, table)
+    else:
+        # One new table for each file
+        table_names = [
+            await reserve_table_name(db, table_name_from_filepath(filepath))
+            for filepath in paths
+        ]
+        path = datasette.urls.database(database)
+
+    async def run(progress):
+        try:
+            results = await import_csv_files_to_database(
+                paths,
+                db,
+                table_names,
+                batch_size=batch_size,
+                progress=progress,
+                create_indexes=bool(data.get("create_indexes")),
+                fast=bool(data.get("fast")),
+                encoding=encoding,
+            )
+        finally:
+            if not table:
+                release_table_names(db, *table_names)
+        for result in results:
+            result["path"] = datasette.urls.table(database, result["table"])
+        return {"rows": progress.rows, "files": results}
+
+    return await _run_job(datasette, data, path, run, throughput=True)
+
+
+async def _run_job(datasette, body, path, fn, throughput=False):
+    """
+    Runs fn(progress) and returns the JSON response for an import or dump -
+    or, if the request body included "background": true, starts it as a job
+
+    throughput adds the elapsed seconds and rows per second to the response,
+    as job status already reports them.
+    """
+    if body.get("background"):
+        job = start_import_job(datasette, fn, path=path)
         return Response.json(
             {
                 "ok": True,
-                "path": datasette.urls.table(database, table_name),
-                "rows": num_rows,
+                "path": path,
+                "job": job.id,
+                "job_path": datasette.urls.path("/-/import-jobs/{}".format(job.id)),
             }
         )
+    progress = ImportProgress()
+    try:
+        result = await fn(progress)
     except Exception as e:
         return error(str(e), status=500)
+    response = dict({"ok": True, "path": path}, **progress.details, **result)
+    if throughput:
+        progress_dict = progress.as_dict()
+        response["elapsed"] = progress_dict["elapsed"]
+        response["rows_per_second"] = progress_dict["rows_per_second"]
+    return Response.json(response)
+
+
+async def import_job_status(request, datasette):
+    if not check_auth(request):
+        return unauthorized
+    job = import_jobs(datasette).get(request.url_vars["job_id"])
+    if job is None:
+        return error("Job not found", status=404)
+    return Response.json(dict({"ok": True}, **job.as_dict()))
+
+
+async def cancel_import_job(request, datasette):
+    if not check_auth(request):
+        return unauthorized
+    if request.method != "POST":
+        return error("Must be a POST", status=405)
+    job = import_jobs(datasette).get(request.url_vars["job_id"])
+    if job is None:
+        return error("Job not found", status=404)
+    if not job.cancel():
+        return error("Job has already finished")
+    return Response.json({"ok": True, "id": job.id})
 
 
 async def auth_app_user(request, datasette):
@@ -284,91 +464,88 @@ async def dump_temporary_to_file(request, datasette):
     if not check_auth(request):
         return unauthorized
     try:
-        filepath = await _filepath_from_json_body(request, must_exist=False)
+        filepath, body = await _filepath_from_json_body(
+            request, must_exist=False, return_data=True
+        )
     except PathError as e:
         return error(e.message)
-    db = datasette.get_database("temporary")
+    autosave = body.get("autosave")
+    if autosave is not None and (
+        not isinstance(autosave, (int, float))
+        or isinstance(autosave, bool)
+        or autosave < 0
+    ):
+        return error("autosave must be a number of seconds")
 
-    def backup(conn):
-        conn.isolation_level = None
-        conn.execute("vacuum into '{}'".format(filepath))
-        conn.isolation_level = ""
+    async def run(progress):
+        await dump_temporary(datasette, filepath, progress=progress)
+        if autosave is not None:
+            schedule_autosave(datasette, filepath, autosave)
+            if autosave:
+                progress.details["autosave"] = autosave
+        return {}
 
-    await db.execute_write_fn(backup, block=True)
-    return Response.json({"ok": True, "path": filepath})
+    return await _run_job(datasette, body, filepath, run)
 
 
 async def restore_temporary_from_file(request, datasette):
     if not check_auth(request):
         return unauthorized
     try:
-        filepath = await _filepath_from_json_body(request)
+        filepath, body = await _filepath_from_json_body(request, return_data=True)
     except PathError as e:
         return error(e.message)
-    temporary = datasette.get_database("temporary")
-    backup_db = sqlite3.connect(filepath, uri=True)
-    temporary_conn = temporary.connect(write=True)
-    backup_db.backup(temporary_conn)
-    backup_tables = [
-        r[0]
-        for r in backup_db.execute(
-            "select name from sqlite_master where type='table'"
-        ).fetchall()
-    ]
-    temporary_conn.close()
-    backup_db.close()
-    return Response.json(
-        {
-            "ok": True,
-            "path": filepath,
-            "restored_tables": await temporary.table_names(),
+    mode = body.get("mode") or "copy"
+    if mode not in ("copy", "attach"):
+        return error("mode must be 'copy' or 'attach'")
+    if mode == "attach":
+        attach_error, attached = await attach_snapshot(datasette, filepath)
+        if attach_error:
+            return error(attach_error)
+        return Response.json(
+            {
+                "ok": True,
+                "path": filepath,
+                "attached": datasette.urls.database(attached.name),
+                "backup_tables": await attached.table_names(),
+            }
+        )
+
+    async def run(progress):
+        backup_tables = await restore_temporary(datasette, filepath, progress=progress)
+        return {
+            "restored_tables": await datasette.get_database("temporary").table_names(),
             "backup_tables": backup_tables,
         }
-    )
+
+    return await _run_job(datasette, body, filepath, run)
 
 
 @hookimpl
 def register_routes():
     return [
         (r"^/-/open-database-file$", open_database_file),
+        (r"^/-/open-database-files$", open_database_files),
+        (r"^/-/open-database-paths$", open_database_paths),
+        (r"^/-/database-profiles$", database_profiles_view),
         (r"^/-/new-empty-database-file$", new_empty_database_file),
         (r"^/-/open-csv-file$", open_csv_file),
         (r"^/-/open-csv-from-url$", open_csv_from_url),
         (r"^/-/import-csv-file$", import_csv_file),
+        (r"^/-/import-csv-files$", import_csv_files),
+        (r"^/-/import-jobs/(?P<job_id>[0-9a-f]+)$", import_job_status),
+        (r"^/-/import-jobs/(?P<job_id>[0-9a-f]+)/cancel$", cancel_import_job),
         (r"^/-/auth-app-user$", auth_app_user),
         (r"^/-/dump-temporary-to-file$", dump_temporary_to_file),
         (r"^/-/restore-temporary-from-file$", restore_temporary_from_file),
     ]
 
 
-def suffix(d):
-    return "th" if 11 <= d <= 13 else {1: "st", 2: "nd", 3: "rd"}.get(d % 10, "th")
-
-
-def prettydate(date):
-    if isinstance(date, str):
-        try:
-            date = parser.parse(date)
-        except parser.ParserError:
-            return date
-    return "{day}{suffix} {month} {year}".format(
-        day=date.day,
-        month=date.strftime("%B"),
-        suffix=suffix(date.day),
-        year=date.year,
-    )
-
-
 @hookimpl
-def extra_template_vars(datasette):
+def extra_template_vars(datasette, template):
     async def inner():
-        return {
-            "prettydate": prettydate,
-            "total_plugin_count": (
-                await datasette.get_database("plugin_directory").execute(
-                    "select count(*) from plugins"
-                )
-            ).single_value(),
-        }
+        return dict(
+            {"prettydate": prettydate}, **await template_vars(datasette, template)
+        )
 
     return inner
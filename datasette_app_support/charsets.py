@@ -0,0 +1,158 @@
+import codecs
+import io
+
+# How many bytes to look at when detecting the encoding of a file
+DETECT_ENCODING_SAMPLE = 64 * 1024
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+)
+# Files that are not valid UTF-8 are most likely to be from Excel on Windows
+FALLBACK_ENCODING = "cp1252"
+TRANSCODE_CHUNK_SIZE = 64 * 1024
+
+
+def _latin1_fallback(error):
+    # cp1252 leaves five bytes undefined - decode those the way latin-1 does
+    if not isinstance(error, UnicodeDecodeError):
+        raise error
+    return (
+        "".join(chr(b) for b in error.object[error.start : error.end]),
+        error.end,
+    )
+
+
+codecs.register_error("app_support_latin1", _latin1_fallback)
+
+
+def encoding_from_body(body):
+    "Returns the encoding requested by an import, or None to detect it"
+    encoding = body.get("encoding")
+    if encoding is None:
+        return None
+    try:
+        return codecs.lookup(encoding).name
+    except (LookupError, TypeError):
+        raise ValueError("Unknown encoding: {}".format(encoding))
+
+
+def detect_encoding(sample):
+    """
+    Returns (encoding, length of byte order mark) for the first bytes of a
+    file - using the byte order mark if there is one, then UTF-8 if the
+    sample is valid UTF-8, otherwise cp1252
+    """
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            return encoding, len(bom)
+    try:
+        # Not final, so a character split at the end of the sample is fine
+        codecs.getincrementaldecoder("utf-8")().decode(sample)
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING, 0
+    return "utf-8", 0
+
+
+class TextDecoder:
+    """
+    Incremental decoder that detects the encoding from the first
+    DETECT_ENCODING_SAMPLE bytes, unless it is given one
+
+    A detected UTF-8 file that turns out to contain invalid UTF-8 later on
+    switches to cp1252 from that point, rather than failing the import.
+    An explicit encoding is strict. encoding is None until it is known.
+    """
+
+    def __init__(self, encoding=None, strict=None):
+        self.encoding = encoding
+        self.strict = (encoding is not None) if strict is None else strict
+        self.switched = False
+        self.sample = b""
+        self.bom = 0
+        self.decoder = None
+        if encoding is not None:
+            self._start(encoding)
+
+    def _start(self, encoding):
+        self.encoding = encoding
+        errors = "app_support_latin1" if encoding == FALLBACK_ENCODING else "strict"
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+
+    def decode(self, data, final=False):
+        if self.decoder is None:
+            self.sample += data
+            if len(self.sample) < DETECT_ENCODING_SAMPLE and not final:
+                return ""
+            encoding, self.bom = detect_encoding(self.sample)
+            self._start(encoding)
+            data, self.sample = self.sample[self.bom :], b""
+        if self.strict or self.encoding != "utf-8":
+            return self.decoder.decode(data, final)
+        held = self.decoder.getstate()[0]
+        try:
+            return self.decoder.decode(data, final)
+        except UnicodeDecodeError as e:
+            # e.start counts from the start of the bytes the decoder had held
+            data = held + data
+            valid = data[: e.start].decode("utf-8")
+            self._start(FALLBACK_ENCODING)
+            self.switched = True
+            return valid + self.decoder.decode(data[e.start :], final)
+
+    def pending_bytes(self):
+        "How many bytes have been passed in but not returned as text yet"
+        if self.decoder is None:
+            return len(self.sample)
+        return len(self.decoder.getstate()[0])
+
+    def encoded_length(self, text):
+        """
+        Returns the number of bytes text took up in the input - or None if
+        that cannot be known, after switching encodings part way through
+        """
+        if self.switched:
+            return None
+        if self.encoding == FALLBACK_ENCODING:
+            return len(text)
+        if self.encoding in ("utf-16", "utf-32") or self.encoding is None:
+            # Encoding these would add a byte order mark
+            return None
+        if self.encoding == "utf-8-sig":
+            return len(text.encode("utf-8"))
+        return len(text.encode(self.encoding))
+
+
+class TranscodedFile(io.RawIOBase):
+    """
+    Read-only binary file object that decodes fp with a TextDecoder and
+    returns the text encoded as UTF-8
+    """
+
+    def __init__(self, fp, encoding=None):
+        self.fp = fp
+        self.decoder = TextDecoder(encoding)
+        self.pending = b""
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending and not self.finished:
+            chunk = self.fp.read(TRANSCODE_CHUNK_SIZE)
+            if not chunk:
+                self.finished = True
+            self.pending = self.decoder.decode(chunk, final=self.finished).encode(
+                "utf-8"
+            )
+        size = min(len(b), len(self.pending))
+        b[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        super().close()
+        self.fp.close()
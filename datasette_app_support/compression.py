@@ -0,0 +1,289 @@
+import bz2
+import gzip
+import lzma
+import os
+import struct
+import zipfile
+import zlib
+
+MAGIC_NUMBERS = (
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"PK\x03\x04", "zip"),
+)
+# Enough bytes to recognize any of the above
+SNIFF_BYTES = 6
+COMPRESSION_EXTENSIONS = (".gz", ".gzip", ".bz2", ".xz", ".zst", ".zstd", ".zip")
+ZIP_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+ZIP_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+ZIP_DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+ZIP64_EXTRA_FIELD = 0x0001
+# The most a single decompress() call can return, so one small but highly
+# compressed chunk cannot expand to fill memory
+MAX_DECOMPRESSED_CHUNK = 1024 * 1024
+# zstandard cannot limit its output, so it is fed input in slices this size -
+# each byte of input can produce at most a few KB of output
+ZSTD_INPUT_SLICE = 256
+
+
+class CompressionError(ValueError):
+    pass
+
+
+def sniff_compression(first_bytes):
+    "Returns gzip, bz2, xz, zstd or zip based on the magic number - or None"
+    for magic, compression in MAGIC_NUMBERS:
+        if first_bytes.startswith(magic):
+            return compression
+    return None
+
+
+def strip_compression_extension(name):
+    "data.csv.gz becomes data.csv"
+    root, ext = os.path.splitext(name)
+    if ext.lower() in COMPRESSION_EXTENSIONS:
+        return root
+    return name
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise CompressionError(
+            "Install the zstandard package to import .zst compressed files"
+        )
+    return zstandard
+
+
+def _zip_member(raw):
+    zf = zipfile.ZipFile(raw)
+    members = [info for info in zf.infolist() if not info.is_dir()]
+    if len(members) != 1:
+        zf.close()
+        raise CompressionError("Zip files must contain exactly one file")
+    return zf.open(members[0])
+
+
+def open_decompressed(raw):
+    """
+    Wraps the binary file object raw in a file object that decompresses it
+    as it is read, if it starts with a known magic number. Returns a tuple
+    of (file object, compression or None).
+    """
+    first_bytes = raw.read(SNIFF_BYTES)
+    raw.seek(0)
+    compression = sniff_compression(first_bytes)
+    if compression is None:
+        return raw, None
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="rb"), compression
+    if compression == "bz2":
+        return bz2.BZ2File(raw, mode="rb"), compression
+    if compression == "xz":
+        return lzma.LZMAFile(raw, mode="rb"), compression
+    if compression == "zstd":
+        return (
+            _zstandard().ZstdDecompressor().stream_reader(raw, closefd=False),
+            compression,
+        )
+    return _zip_member(raw), compression
+
+
+def _decompressor(compression):
+    if compression == "gzip":
+        # 16 + MAX_WBITS expects a gzip header
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == "bz2":
+        return bz2.BZ2Decompressor()
+    if compression == "xz":
+        return lzma.LZMADecompressor()
+    return _zstandard().ZstdDecompressor().decompressobj()
+
+
+def _decompress_limited(decompressor, data):
+    """
+    Yields the output of decompressing data in pieces of at most
+    MAX_DECOMPRESSED_CHUNK bytes, stopping at the end of the stream
+    """
+    if hasattr(decompressor, "unconsumed_tail"):
+        # zlib keeps the input it has not used yet, rather than buffering it
+        while data and not decompressor.eof:
+            yield decompressor.decompress(data, MAX_DECOMPRESSED_CHUNK)
+            data = decompressor.unconsumed_tail
+        return
+    yield decompressor.decompress(data, MAX_DECOMPRESSED_CHUNK)
+    while not decompressor.eof and not decompressor.needs_input:
+        yield decompressor.decompress(b"", MAX_DECOMPRESSED_CHUNK)
+
+
+async def _decompress_stream(chunks, compression):
+    decompressor = _decompressor(compression)
+    async for chunk in chunks:
+        if compression == "zstd":
+            for i in range(0, len(chunk), ZSTD_INPUT_SLICE):
+                yield decompressor.decompress(chunk[i : i + ZSTD_INPUT_SLICE])
+            continue
+        while chunk:
+            for output in _decompress_limited(decompressor, chunk):
+                yield output
+            chunk = b""
+            if decompressor.eof:
+                # Concatenated streams, such as from pigz, are one file
+                chunk = decompressor.unused_data
+                decompressor = _decompressor(compression)
+    if compression == "gzip":
+        yield decompressor.flush()
+
+
+async def _prepend(first, chunks):
+    if first:
+        yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+class _ZipReader:
+    "Reads a zip file from an async iterator of bytes, front to back"
+
+    def __init__(self, chunks):
+        self.chunks = chunks.__aiter__()
+        self.buffer = b""
+
+    async def fill(self, size):
+        "Buffers at least size bytes, returning False if the file ends first"
+        while len(self.buffer) < size:
+            try:
+                self.buffer += await self.chunks.__anext__()
+            except StopAsyncIteration:
+                return False
+        return True
+
+    async def read(self, size):
+        if not await self.fill(size):
+            raise CompressionError("Zip file ended unexpectedly")
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    async def data(self):
+        "Yields the buffered bytes, then the rest of the file"
+        while True:
+            if self.buffer:
+                data, self.buffer = self.buffer, b""
+                yield data
+            if not await self.fill(1):
+                return
+
+    async def local_header(self):
+        """
+        Returns (header, zip64) for the next member that is not a directory,
+        or None once the local headers are followed by the central directory
+        """
+        while True:
+            if not await self.fill(4) or not self.buffer.startswith(
+                ZIP_LOCAL_HEADER_SIGNATURE
+            ):
+                return None
+            header = ZIP_LOCAL_HEADER.unpack(await self.read(ZIP_LOCAL_HEADER.size))
+            flags, compressed_size = header[2], header[7]
+            name = await self.read(header[9])
+            extra = await self.read(header[10])
+            if not name.endswith(b"/"):
+                return header, _has_zip64_extra(extra)
+            # Directories have no data of their own
+            if flags & 0x08:
+                raise CompressionError("Zip file directory entries must be sized")
+            await self.read(compressed_size)
+
+
+def _has_zip64_extra(extra):
+    while len(extra) >= 4:
+        field, size = struct.unpack("<HH", extra[:4])
+        if field == ZIP64_EXTRA_FIELD:
+            return True
+        extra = extra[4 + size :]
+    return False
+
+
+async def _decompress_zip_stream(chunks):
+    """
+    Streams the only file in a zip file from its local file header, which
+    is all that is needed as the central directory is at the end - then
+    checks the local headers that follow for a second file
+    """
+    reader = _ZipReader(chunks)
+    found = await reader.local_header()
+    if found is None:
+        raise CompressionError("Zip files must contain exactly one file")
+    header, zip64 = found
+    flags, method, compressed_size = header[2], header[3], header[7]
+    if flags & 0x01:
+        raise CompressionError("Encrypted zip files are not supported")
+    if method == zipfile.ZIP_STORED:
+        if flags & 0x08:
+            raise CompressionError(
+                "Uncompressed zip files must include the size of the file"
+            )
+        remaining = compressed_size
+        while remaining:
+            data = await reader.read(min(remaining, 64 * 1024))
+            remaining -= len(data)
+            yield data
+    elif method == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        async for chunk in reader.data():
+            for output in _decompress_limited(decompressor, chunk):
+                yield output
+            if decompressor.eof:
+                # Anything after this is the rest of the archive
+                reader.buffer = decompressor.unused_data + reader.buffer
+                break
+        else:
+            raise CompressionError("Zip file ended unexpectedly")
+    else:
+        raise CompressionError("Zip files must use deflate compression")
+    if flags & 0x08:
+        # Skip the data descriptor, which may or may not have a signature
+        if await reader.fill(4) and reader.buffer.startswith(
+            ZIP_DATA_DESCRIPTOR_SIGNATURE
+        ):
+            await reader.read(4)
+        await reader.read(20 if zip64 else 12)
+    if await reader.local_header() is not None:
+        raise CompressionError("Zip files must contain exactly one file")
+
+
+class DecompressedStream:
+    """
+    Wraps an async iterator of bytes, such as an HTTP response body, and
+    yields the bytes decompressed if it starts with a known magic number
+
+    compression is set to the compression that was found, or None, before
+    the first bytes are yielded.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.compression = None
+
+    def __aiter__(self):
+        return self._decompress()
+
+    async def _decompress(self):
+        chunks = self.chunks.__aiter__()
+        first = b""
+        async for chunk in chunks:
+            first += chunk
+            if len(first) >= SNIFF_BYTES:
+                break
+        self.compression = sniff_compression(first)
+        stream = _prepend(first, chunks)
+        if self.compression == "zip":
+            stream = _decompress_zip_stream(stream)
+        elif self.compression is not None:
+            stream = _decompress_stream(stream, self.compression)
+        async for chunk in stream:
+            if chunk:
+                yield chunk
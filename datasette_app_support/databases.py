@@ -0,0 +1,464 @@
+from datasette.database import Database
+from datasette.utils import sqlite3
+import asyncio
+import collections
+import os
+import pathlib
+import struct
+import threading
+
+
+class DatabasePathRegistry:
+    """
+    Index of the files behind attached databases, keyed by resolved path and
+    by (device, inode), so checking whether a file is already open does not
+    need to resolve the path of every attached database
+
+    Datasette has no hook for databases being added or removed, so sync()
+    compares against datasette.databases and only stats the new ones.
+    """
+
+    def __init__(self):
+        self.by_name = {}
+        self.by_path = {}
+        self.by_inode = {}
+
+    def add(self, db):
+        if (
+            not db.path
+            or db.name in self.by_name
+            or getattr(db, "_app_support_scratch", False)
+        ):
+            return
+        resolved = str(pathlib.Path(db.path).resolve())
+        try:
+            stat = os.stat(resolved)
+            inode = (stat.st_dev, stat.st_ino)
+        except OSError:
+            inode = None
+        self.by_name[db.name] = {
+            "db": db,
+            "path": db.path,
+            "resolved_path": resolved,
+            "inode": inode,
+        }
+        self.by_path[resolved] = db.name
+        if inode is not None:
+            self.by_inode[inode] = db.name
+
+    def remove(self, name):
+        entry = self.by_name.pop(name, None)
+        if entry is None:
+            return
+        if self.by_path.get(entry["resolved_path"]) == name:
+            del self.by_path[entry["resolved_path"]]
+        if entry["inode"] is not None and self.by_inode.get(entry["inode"]) == name:
+            del self.by_inode[entry["inode"]]
+
+    def sync(self, databases):
+        for name, entry in list(self.by_name.items()):
+            if databases.get(name) is not entry["db"]:
+                self.remove(name)
+        for db in databases.values():
+            if db.name not in self.by_name:
+                self.add(db)
+
+    def find(self, filepath):
+        "Returns the name of the attached database for filepath, or None"
+        resolved = str(pathlib.Path(filepath).resolve())
+        if resolved in self.by_path:
+            return self.by_path[resolved]
+        try:
+            stat = os.stat(resolved)
+        except OSError:
+            return None
+        # Catches hard links and case-insensitive filesystems
+        return self.by_inode.get((stat.st_dev, stat.st_ino))
+
+    def as_list(self):
+        return [
+            {
+                "name": name,
+                "path": entry["path"],
+                "resolved_path": entry["resolved_path"],
+                "device": entry["inode"][0] if entry["inode"] else None,
+                "inode": entry["inode"][1] if entry["inode"] else None,
+            }
+            for name, entry in self.by_name.items()
+        ]
+
+
+def path_registry(datasette):
+    "Returns the DatabasePathRegistry for datasette, synced with its databases"
+    registry = getattr(datasette, "_app_support_path_registry", None)
+    if registry is None:
+        registry = datasette._app_support_path_registry = DatabasePathRegistry()
+    registry.sync(datasette.databases)
+    return registry
+
+
+# Performance profiles that can be applied to databases opened by the app.
+# "database" pragmas are persistent and set once when the file is attached,
+# "connection" pragmas are set on every connection Datasette opens to it.
+PROFILES = {
+    "default": {
+        "description": "SQLite's default settings",
+        "database": {},
+        "connection": {},
+    },
+    "read-heavy": {
+        "description": "Large page cache and memory-mapped I/O for browsing big files",
+        "database": {"journal_mode": "wal"},
+        "connection": {
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -64 * 1024,
+            "temp_store": "memory",
+        },
+    },
+    "import-heavy": {
+        "description": "WAL with relaxed syncing and a large cache for bulk imports",
+        "database": {"journal_mode": "wal"},
+        "connection": {
+            "synchronous": "normal",
+            "cache_size": -128 * 1024,
+            "temp_store": "memory",
+        },
+    },
+}
+
+
+def profile_from_body(body):
+    profile = body.get("profile") or "default"
+    if profile not in PROFILES:
+        raise ValueError(
+            "profile must be one of: {}".format(", ".join(sorted(PROFILES)))
+        )
+    return profile
+
+
+def database_profiles(datasette):
+    "Returns the {database name: profile name} dictionary for datasette"
+    if not hasattr(datasette, "_app_support_profiles"):
+        datasette._app_support_profiles = {}
+    return datasette._app_support_profiles
+
+
+def _pragmas(conn, pragmas):
+    for name, value in pragmas.items():
+        conn.execute("pragma {} = {}".format(name, value))
+
+
+def apply_database_pragmas(filepath, profile):
+    "Sets the persistent pragmas for profile on the file at filepath"
+    pragmas = PROFILES[profile]["database"]
+    if not pragmas:
+        return
+    conn = sqlite3.connect(filepath)
+    try:
+        _pragmas(conn, pragmas)
+    finally:
+        conn.close()
+
+
+def apply_connection_pragmas(conn, database, datasette):
+    "Called by prepare_connection for every new connection"
+    profile = database_profiles(datasette).get(database)
+    if profile:
+        _pragmas(conn, PROFILES[profile]["connection"])
+
+
+class ReadOnlyDatabase(Database):
+    """
+    A database that is only ever opened with mode=ro, write connection
+    included
+
+    Datasette treats it as mutable, so it is never hashed or fully counted -
+    reading the whole of a very large file would block the event loop.
+    """
+
+    def connect(self, write=False):
+        return super().connect(write=False)
+
+
+async def add_profiled_database(
+    datasette, filepath, profile="default", read_only=False
+):
+    """
+    Applies profile to filepath, then attaches it as a mutable database - or
+    a ReadOnlyDatabase, which is never written to - and registers it in the
+    path registry. Returns the new Database.
+    """
+    if PROFILES[profile]["database"] and not read_only:
+        await asyncio.get_event_loop().run_in_executor(
+            None, apply_database_pragmas, filepath, profile
+        )
+    database_class = ReadOnlyDatabase if read_only else Database
+    added_db = datasette.add_database(database_class(datasette, path=filepath))
+    if profile == "default":
+        database_profiles(datasette).pop(added_db.name, None)
+    else:
+        database_profiles(datasette)[added_db.name] = profile
+    path_registry(datasette).add(added_db)
+    return added_db
+
+
+# The only journal modes stored in the file - the others only last as long
+# as the connection that set them
+JOURNAL_MODES = ("delete", "wal")
+AUTO_VACUUM_MODES = ("none", "full", "incremental")
+
+
+def creation_options_from_body(body):
+    "Validates and returns create_database_file() keyword arguments"
+    options = {}
+    page_size = body.get("page_size")
+    if page_size is not None:
+        if (
+            not isinstance(page_size, int)
+            or isinstance(page_size, bool)
+            or not (512 <= page_size <= 65536)
+            or page_size & (page_size - 1)
+        ):
+            raise ValueError("page_size must be a power of two between 512 and 65536")
+        options["page_size"] = page_size
+    for key, allowed in (
+        ("journal_mode", JOURNAL_MODES),
+        ("auto_vacuum", AUTO_VACUUM_MODES),
+    ):
+        value = body.get(key)
+        if value is not None:
+            if value not in allowed:
+                raise ValueError(
+                    "{} must be one of: {}".format(key, ", ".join(allowed))
+                )
+            options[key] = value
+    schema = body.get("schema")
+    template = body.get("template")
+    if schema is not None and template is not None:
+        raise ValueError("Use either 'schema' or 'template', not both")
+    if schema is not None:
+        if not isinstance(schema, str):
+            raise ValueError("schema must be a string of SQL")
+        options["schema"] = schema
+    if template is not None:
+        if not isinstance(template, str) or probe_sqlite_file(template)[0]:
+            raise ValueError("template must be the path to a SQLite database")
+        options["template"] = template
+    return options
+
+
+def template_schema(template):
+    "Returns the CREATE statements needed to copy the schema of template"
+    uri = pathlib.Path(template).resolve().as_uri() + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True)
+    try:
+        return conn.execute("""
+            select type, name, sql from sqlite_master
+            where sql is not null and name not like 'sqlite_%'
+            order by case type
+              when 'table' then 0 when 'index' then 1 when 'view' then 2 else 3
+            end, rowid
+            """).fetchall()
+    finally:
+        conn.close()
+
+
+def create_database_file(
+    filepath,
+    page_size=None,
+    journal_mode=None,
+    auto_vacuum=None,
+    schema=None,
+    template=None,
+):
+    """
+    Creates a new SQLite database file with the page size, journal mode and
+    auto_vacuum setting it will need for imports, so it never has to be
+    rebuilt with VACUUM later. schema is SQL to run, template is the path
+    to a database whose tables, indexes, views and triggers are copied.
+    """
+    conn = sqlite3.connect(filepath)
+    try:
+        # page_size and auto_vacuum must be set before anything is written
+        if page_size:
+            conn.execute("pragma page_size = {}".format(page_size))
+        if auto_vacuum:
+            conn.execute("pragma auto_vacuum = {}".format(auto_vacuum))
+        conn.execute("vacuum")
+        if journal_mode:
+            conn.execute("pragma journal_mode = {}".format(journal_mode))
+        if template:
+            with conn:
+                for type_, name, sql in template_schema(template):
+                    # Shadow tables for FTS and other virtual tables are
+                    # created along with the virtual table itself
+                    exists = conn.execute(
+                        "select 1 from sqlite_master where type = ? and name = ?",
+                        [type_, name],
+                    ).fetchone()
+                    if not exists:
+                        conn.execute(sql)
+        if schema:
+            conn.executescript(schema)
+    except Exception:
+        conn.close()
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(filepath + suffix):
+                os.remove(filepath + suffix)
+        raise
+    conn.close()
+
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+TEXT_ENCODINGS = {1: "utf-8", 2: "utf-16le", 3: "utf-16be"}
+# How many (path, mtime) probe results to remember
+PROBE_CACHE_SIZE = 512
+
+_probe_cache = collections.OrderedDict()
+# attach_database_files() probes files from several executor threads at once
+_probe_cache_lock = threading.Lock()
+
+
+def read_sqlite_header(filepath):
+    """
+    Parses the 100 byte header at the start of a SQLite database file,
+    without opening a connection. Returns None if it is not a SQLite file.
+
+    https://www.sqlite.org/fileformat.html#the_database_header
+    """
+    with open(filepath, "rb") as fp:
+        header = fp.read(100)
+    if len(header) < 100 or not header.startswith(SQLITE_HEADER):
+        return None
+    (page_size,) = struct.unpack(">H", header[16:18])
+    if page_size == 1:
+        page_size = 65536
+    write_version, read_version = header[18], header[19]
+    (
+        change_counter,
+        page_count,
+        _,
+        _,
+        schema_version,
+        _,
+        _,
+        _,
+        text_encoding,
+        user_version,
+    ) = struct.unpack(">10I", header[24:64])
+    (application_id,) = struct.unpack(">I", header[68:72])
+    version_valid_for, sqlite_version = struct.unpack(">II", header[92:100])
+    size = os.path.getsize(filepath)
+    if change_counter != version_valid_for or not page_count:
+        # Header page count is only trustworthy if it was written by a
+        # recent enough version of SQLite - otherwise use the file size
+        page_count = size // page_size
+    return {
+        "size": size,
+        "page_size": page_size,
+        "page_count": page_count,
+        "journal_mode": (
+            "wal" if (write_version, read_version) == (2, 2) else "rollback"
+        ),
+        "schema_version": schema_version,
+        "encoding": TEXT_ENCODINGS.get(text_encoding),
+        "user_version": user_version,
+        "application_id": application_id,
+        "sqlite_version": "{}.{}.{}".format(
+            sqlite_version // 1000000,
+            sqlite_version // 1000 % 1000,
+            sqlite_version % 1000,
+        ),
+    }
+
+
+def _probe(filepath):
+    if os.path.getsize(filepath) == 0:
+        # SQLite treats an empty file as an empty database
+        info = {"size": 0, "page_size": None, "page_count": 0}
+    else:
+        info = read_sqlite_header(filepath)
+        if info is None:
+            return "Not a valid SQLite database", None
+    uri = pathlib.Path(filepath).resolve().as_uri() + "?mode=ro"
+    try:
+        conn = sqlite3.connect(uri, uri=True)
+    except sqlite3.Error:
+        return "Not a valid SQLite database", None
+    try:
+        counts = dict(
+            conn.execute(
+                "select type, count(*) from sqlite_master group by type"
+            ).fetchall()
+        )
+    except sqlite3.DatabaseError:
+        return "Not a valid SQLite database", None
+    finally:
+        conn.close()
+    info["tables"] = counts.get("table", 0)
+    info["views"] = counts.get("view", 0)
+    info["indexes"] = counts.get("index", 0)
+    return None, info
+
+
+def probe_sqlite_file(filepath):
+    """
+    Returns (error, info) for filepath - error is a message if it is not a
+    valid SQLite database, info is a dictionary of details read from its
+    header plus counts of tables, views and indexes
+
+    Results are cached by path, size and modification time.
+    """
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return "'path' does not exist", None
+    if not os.path.isfile(filepath):
+        return "'path' does not exist", None
+    key = (str(pathlib.Path(filepath).resolve()), stat.st_mtime_ns, stat.st_size)
+    with _probe_cache_lock:
+        result = _probe_cache.get(key)
+        if result is not None:
+            _probe_cache.move_to_end(key)
+    if result is None:
+        # Probed outside of the lock, so other files can be probed meanwhile
+        result = _probe(filepath)
+        with _probe_cache_lock:
+            _probe_cache[key] = result
+            while len(_probe_cache) > PROBE_CACHE_SIZE:
+                _probe_cache.popitem(last=False)
+    error, info = result
+    return error, dict(info) if info else None
+
+
+async def attach_database_files(
+    datasette, filepaths, profile="default", read_only=False
+):
+    """
+    Validates filepaths concurrently in a thread pool, then attaches each
+    valid file that is not already open. Returns a result for each file.
+    """
+    loop = asyncio.get_event_loop()
+    probes = await asyncio.gather(
+        *[loop.run_in_executor(None, probe_sqlite_file, path) for path in filepaths]
+    )
+    registry = path_registry(datasette)
+    results = []
+    for filepath, (error, info) in zip(filepaths, probes):
+        if error is None and registry.find(filepath):
+            error = "That file is already open"
+        if error is not None:
+            results.append({"file": filepath, "ok": False, "error": error})
+            continue
+        added_db = await add_profiled_database(
+            datasette, filepath, profile, read_only=read_only
+        )
+        results.append(
+            {
+                "file": filepath,
+                "ok": True,
+                "path": datasette.urls.database(added_db.name),
+                "file_info": info,
+            }
+        )
+    return results
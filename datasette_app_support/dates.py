@@ -0,0 +1,39 @@
+import datetime
+import functools
+
+
+def suffix(d):
+    return "th" if 11 <= d <= 13 else {1: "st", 2: "nd", 3: "rd"}.get(d % 10, "th")
+
+
+def _format(date):
+    return "{day}{suffix} {month} {year}".format(
+        day=date.day,
+        month=date.strftime("%B"),
+        suffix=suffix(date.day),
+        year=date.year,
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _prettydate_string(date):
+    try:
+        # fromisoformat() only understands a trailing Z from Python 3.11
+        parsed = datetime.datetime.fromisoformat(
+            date[:-1] + "+00:00" if date.endswith("Z") else date
+        )
+    except (AttributeError, ValueError):
+        # dateutil is slow to import, and rarely needed for plugins.json
+        from dateutil import parser
+
+        try:
+            parsed = parser.parse(date)
+        except (parser.ParserError, OverflowError):
+            return date
+    return _format(parsed)
+
+
+def prettydate(date):
+    if isinstance(date, str):
+        return _prettydate_string(date)
+    return _format(date)
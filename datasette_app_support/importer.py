@@ -0,0 +1,779 @@
+from .charsets import TranscodedFile
+from .compression import open_decompressed
+import asyncio
+import itertools
+import os
+import re
+import threading
+import time
+
+DEFAULT_BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 100000
+# Batches are sized to roughly this many bytes when no batch_size is given
+TARGET_BATCH_BYTES = 512 * 1024
+MIN_SIZED_BATCH = 100
+MAX_SIZED_BATCH = 10000
+# How many rows to sample when detecting column types
+DETECT_TYPES_SAMPLE = 1000
+# Columns with at most this many distinct values are indexed as facets
+FACET_MAX_DISTINCT = 200
+MAX_RECOMMENDED_INDEXES = 5
+# How many rows to profile when recommending indexes
+INDEX_PROFILE_ROWS = 100000
+# How many parsed batches can wait in the queue for the writer
+QUEUED_BATCHES = 4
+# Page cache used by the write connection during a "fast" import
+FAST_IMPORT_CACHE_KIB = 256 * 1024
+# How often to check that parse worker processes are still alive, and for
+# workers to check whether the import they are parsing for has stopped
+WORKER_POLL_INTERVAL = 0.5
+
+_DONE = object()
+
+_INTEGER_RE = re.compile(r"^[-+]?(0|[1-9][0-9]{0,17})$")
+_DIGITS_RE = re.compile(r"^[-+]?[0-9]+$")
+_FLOAT_RE = re.compile(
+    r"^[-+]?((0|[1-9][0-9]*)(\.[0-9]*)?|\.[0-9]+)([eE][-+]?[0-9]+)?$"
+)
+_TYPE_ORDER = (int, float, str)
+SQL_TYPES = {int: "INTEGER", float: "REAL", str: "TEXT"}
+
+
+class ImportProgress:
+    "Tracks how far an import has got, for reporting throughput"
+
+    def __init__(self, total_bytes=None):
+        self.total_bytes = total_bytes
+        self.bytes_read = 0
+        self.rows = 0
+        self.batches = 0
+        self.started = time.monotonic()
+        self.finished = None
+        # Extra information about the import to include in the response
+        self.details = {}
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        if not elapsed:
+            return None
+        return self.rows / elapsed
+
+    @property
+    def eta(self):
+        "Estimated seconds remaining, based on bytes read so far"
+        if self.finished:
+            return 0
+        if not self.total_bytes or not self.bytes_read:
+            return None
+        bytes_per_second = self.bytes_read / self.elapsed
+        return max(self.total_bytes - self.bytes_read, 0) / bytes_per_second
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def as_dict(self):
+        return {
+            "rows": self.rows,
+            "batches": self.batches,
+            "bytes_read": self.bytes_read,
+            "total_bytes": self.total_bytes,
+            "elapsed": round(self.elapsed, 3),
+            "rows_per_second": (
+                round(self.rows_per_second, 1)
+                if self.rows_per_second is not None
+                else None
+            ),
+            "eta": round(self.eta, 1) if self.eta is not None else None,
+            **self.details,
+        }
+
+
+def batch_size_from_body(body):
+    batch_size = body.get("batch_size")
+    if batch_size is None:
+        return DEFAULT_BATCH_SIZE
+    if (
+        not isinstance(batch_size, int)
+        or isinstance(batch_size, bool)
+        or not (0 < batch_size <= MAX_BATCH_SIZE)
+    ):
+        raise ValueError(
+            "batch_size must be an integer between 1 and {}".format(MAX_BATCH_SIZE)
+        )
+    return batch_size
+
+
+def value_type(value):
+    """
+    Returns int, float or str - the narrowest column type that can hold value
+
+    Integers with leading zeros, such as ZIP codes, and integers too large
+    for SQLite to store without losing precision are treated as text.
+    """
+    if isinstance(value, (bool, int)):
+        return int if abs(value) < 2**63 else str
+    if isinstance(value, float):
+        return float
+    if not isinstance(value, str):
+        return str
+    value = value.strip()
+    if _INTEGER_RE.match(value):
+        return int
+    if _DIGITS_RE.match(value):
+        return str
+    if _FLOAT_RE.match(value):
+        return float
+    return str
+
+
+def infer_column_types(rows):
+    "Returns a {column: int, float or str} dictionary for a sample of rows"
+    types = {}
+    for row in rows:
+        for key, value in row.items():
+            current = types.get(key)
+            if current is str:
+                continue
+            if value is None or value == "":
+                types.setdefault(key, None)
+                continue
+            new = value_type(value)
+            if current is None or _TYPE_ORDER.index(new) > _TYPE_ORDER.index(current):
+                types[key] = new
+    # Columns that were empty in every sampled row are stored as text
+    return {key: (type_ or str) for key, type_ in types.items()}
+
+
+async def typed_batches(batches, column_types, sample_size=None):
+    """
+    Buffers batches until sample_size rows have been seen, then populates the
+    column_types dictionary from them before yielding any batches.
+
+    Empty strings in numeric columns become nulls. Any other value that does
+    not match its column's type is left alone - SQLite's column affinity then
+    stores it as text rather than failing the import.
+    """
+    sample_size = sample_size or DETECT_TYPES_SAMPLE
+    buffered = []
+    buffered_rows = 0
+    numeric_columns = None
+
+    def clean(batch):
+        if not numeric_columns:
+            return batch
+        for row in batch:
+            for key in numeric_columns:
+                if row.get(key) == "":
+                    row[key] = None
+        return batch
+
+    async for batch in batches:
+        if numeric_columns is None:
+            buffered.append(batch)
+            buffered_rows += len(batch)
+            if buffered_rows < sample_size:
+                continue
+            column_types.update(
+                infer_column_types(
+                    itertools.islice(itertools.chain(*buffered), sample_size)
+                )
+            )
+            numeric_columns = [
+                key for key, type_ in column_types.items() if type_ is not str
+            ]
+            for batch in buffered:
+                yield clean(batch)
+            buffered = None
+        else:
+            yield clean(batch)
+    if buffered:
+        column_types.update(infer_column_types(itertools.chain(*buffered)))
+        numeric_columns = [
+            key for key, type_ in column_types.items() if type_ is not str
+        ]
+        for batch in buffered:
+            yield clean(batch)
+
+
+async def file_row_batches(fp, batch_size, progress, raw=None):
+    """
+    Yield lists of up to batch_size rows from a CSV, TSV or JSON file,
+    parsing each batch in a thread so the event loop is not blocked
+
+    If fp decompresses the file raw, progress is measured through raw.
+    """
+    from sqlite_utils.utils import rows_from_file
+
+    loop = asyncio.get_event_loop()
+    rows = (await loop.run_in_executor(None, rows_from_file, fp))[0]
+    rows = iter(rows)
+
+    def next_batch():
+        return list(itertools.islice(rows, batch_size))
+
+    while True:
+        batch = await loop.run_in_executor(None, next_batch)
+        if fp.closed:
+            # rows_from_file() closes the file once it has been fully read
+            progress.bytes_read = progress.total_bytes or progress.bytes_read
+        else:
+            progress.bytes_read = (raw or fp).tell()
+        if not batch:
+            break
+        yield batch
+
+
+async def sized_batches(row_lists, target_bytes=TARGET_BATCH_BYTES):
+    """
+    Re-group an async iterator of lists of rows into batches of roughly
+    target_bytes each, based on the average width of the first rows seen
+    """
+    batch = []
+    batch_size = None
+    async for rows in row_lists:
+        if batch_size is None and rows:
+            sample = rows[:100]
+            width = sum(
+                len(str(value))
+                for row in sample
+                for value in row.values()
+                if value is not None
+            ) / len(sample)
+            batch_size = min(
+                max(int(target_bytes / max(width, 1)), MIN_SIZED_BATCH),
+                MAX_SIZED_BATCH,
+            )
+        batch.extend(rows)
+        while batch_size and len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+    if batch:
+        yield batch
+
+
+async def queued_batches(batches, maxsize=QUEUED_BATCHES):
+    """
+    Consume batches in a separate task, buffering up to maxsize of them in
+    a queue - so parsing the next batches overlaps with writing this one
+    """
+    queue = asyncio.Queue(maxsize)
+
+    async def produce():
+        try:
+            async for batch in batches:
+                await queue.put(batch)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(_DONE)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
+
+
+async def write_row_batches(
+    db, table_name, batches, progress, column_types=None, after_write=None
+):
+    """
+    Write each batch in its own transaction, releasing the write thread
+    between batches so that other writes to the database can proceed
+
+    column_types is used for the column types if the table is created.
+    after_write(conn, rows), if provided, is called on the write thread
+    after each batch with the total number of rows written so far.
+    """
+    import sqlite_utils
+
+    async for batch in batches:
+
+        def _write(conn):
+            db_conn = sqlite_utils.Database(conn)
+            db_conn[table_name].insert_all(
+                batch, batch_size=len(batch), columns=column_types or None
+            )
+            if after_write is not None:
+                after_write(conn, progress.rows + len(batch))
+
+        await db.execute_write_fn(_write, block=True)
+        progress.rows += len(batch)
+        progress.batches += 1
+
+
+def recommend_indexes(conn, table_name, column_types=None):
+    """
+    Profiles the distinct values in each column of table_name and returns
+    a list of columns that are worth indexing, best candidates first
+
+    Low cardinality columns are likely to be used for facets. Numeric
+    columns - known if types were detected - are likely to be used for
+    sorting and range filters.
+    """
+    columns = [
+        row[1] for row in conn.execute("pragma table_info([{}])".format(table_name))
+    ]
+    if not columns:
+        return []
+    counts = conn.execute(
+        "select count(*), {} from (select * from [{}] limit {})".format(
+            ", ".join("count(distinct [{}])".format(column) for column in columns),
+            table_name,
+            INDEX_PROFILE_ROWS,
+        )
+    ).fetchone()
+    num_rows, distinct_counts = counts[0], dict(zip(columns, counts[1:]))
+    if num_rows < 2:
+        return []
+    numeric = {
+        column
+        for column, type_ in (column_types or {}).items()
+        if type_ in (int, float)
+    }
+    facets = [
+        column
+        for column in columns
+        if 1 < distinct_counts[column] <= FACET_MAX_DISTINCT
+        and distinct_counts[column] <= num_rows / 2
+    ]
+    facets.sort(key=lambda column: distinct_counts[column])
+    filters = [
+        column
+        for column in columns
+        if column in numeric and column not in facets and distinct_counts[column] > 1
+    ]
+    return (facets + filters)[:MAX_RECOMMENDED_INDEXES]
+
+
+def create_recommended_indexes(conn, table_name, column_types=None):
+    "Creates indexes for recommend_indexes(), runs ANALYZE, returns index names"
+    import sqlite_utils
+
+    db = sqlite_utils.Database(conn)
+    table = db[table_name]
+    existing = {tuple(index.columns) for index in table.indexes}
+    created = []
+    for column in recommend_indexes(conn, table_name, column_types):
+        if (column,) in existing:
+            continue
+        table.create_index([column], find_unique_name=True)
+        created.append(
+            next(index.name for index in table.indexes if index.columns == [column])
+        )
+    with conn:
+        conn.execute("analyze [{}]".format(table_name))
+    return created
+
+
+def import_options_from_body(body):
+    "Returns write_rows_to_table() keyword arguments for an import request"
+    return {
+        "detect_types": bool(body.get("detect_types")),
+        "create_indexes": bool(body.get("create_indexes")),
+        "fast": bool(body.get("fast")),
+    }
+
+
+def _fast_import_state(db):
+    # Shared by every fast import into db, since they use the same connection
+    if not hasattr(db, "_app_support_fast_imports"):
+        db._app_support_fast_imports = {"running": 0, "pragmas": {}}
+    return db._app_support_fast_imports
+
+
+class FastImport:
+    """
+    Relaxes durability on the write connection while rows are loaded into
+    table_name: synchronous=OFF, a large page cache, and the table's indexes
+    dropped so they can be built once at the end instead of on every insert
+
+    start() and finish() must run on the write connection. If the import
+    fails, rollback() deletes the rows it added - or the table, if the
+    import created it - before finish() puts things back. Fast imports into
+    the same database can overlap: the connection's original settings are
+    saved by the first to start and restored by the last to finish.
+    """
+
+    def __init__(self, db, table_name):
+        self.state = _fast_import_state(db)
+        self.table_name = table_name
+        self.indexes = []
+        self.existed = False
+        self.max_rowid = None
+
+    def start(self, conn):
+        self.existed = bool(
+            conn.execute(
+                "select 1 from sqlite_master where type = 'table' and name = ?",
+                [self.table_name],
+            ).fetchone()
+        )
+        if self.existed:
+            self.max_rowid = conn.execute(
+                "select max(rowid) from [{}]".format(self.table_name)
+            ).fetchone()[0]
+            # Unique indexes stay, since the rows being loaded must obey them
+            deferrable = {
+                row[1]
+                for row in conn.execute(
+                    "pragma index_list([{}])".format(self.table_name)
+                )
+                if not row[2] and row[3] == "c"
+            }
+            self.indexes = [
+                (name, sql)
+                for name, sql in conn.execute(
+                    "select name, sql from sqlite_master where type = 'index' "
+                    "and tbl_name = ?",
+                    [self.table_name],
+                )
+                if name in deferrable
+            ]
+            with conn:
+                for name, _ in self.indexes:
+                    conn.execute("drop index [{}]".format(name))
+        if not self.state["running"]:
+            self.state["pragmas"] = {
+                pragma: conn.execute("pragma {}".format(pragma)).fetchone()[0]
+                for pragma in ("synchronous", "cache_size")
+            }
+            conn.execute("pragma synchronous = off")
+            conn.execute("pragma cache_size = -{}".format(FAST_IMPORT_CACHE_KIB))
+        self.state["running"] += 1
+
+    def rollback(self, conn):
+        with conn:
+            if not self.existed:
+                conn.execute("drop table if exists [{}]".format(self.table_name))
+            elif self.max_rowid is None:
+                conn.execute("delete from [{}]".format(self.table_name))
+            else:
+                conn.execute(
+                    "delete from [{}] where rowid > ?".format(self.table_name),
+                    [self.max_rowid],
+                )
+
+    def finish(self, conn):
+        if self.indexes:
+            with conn:
+                for _, sql in self.indexes:
+                    conn.execute(sql)
+        self.state["running"] -= 1
+        if not self.state["running"]:
+            for pragma, value in self.state["pragmas"].items():
+                conn.execute("pragma {} = {}".format(pragma, value))
+
+
+async def write_rows_to_table(
+    db,
+    table_name,
+    batches,
+    progress,
+    detect_types=False,
+    create_indexes=False,
+    fast=False,
+    after_write=None,
+):
+    """
+    Runs batches through the write pipeline, with optional type detection,
+    a fast mode that relaxes durability while loading, and creation of
+    indexes once all of the rows have been written
+    """
+    column_types = None
+    if detect_types:
+        column_types = {}
+        batches = typed_batches(batches, column_types)
+    fast_import = FastImport(db, table_name) if fast else None
+    if fast_import:
+        await db.execute_write_fn(fast_import.start, block=True)
+    try:
+        await write_row_batches(
+            db,
+            table_name,
+            queued_batches(batches),
+            progress,
+            column_types=column_types,
+            after_write=after_write,
+        )
+    except BaseException:
+        if fast_import:
+            try:
+                await db.execute_write_fn(fast_import.rollback, block=True)
+            finally:
+                await db.execute_write_fn(fast_import.finish, block=True)
+            progress.rows = 0
+        raise
+    if fast_import:
+        await db.execute_write_fn(fast_import.finish, block=True)
+    if column_types is not None:
+        progress.details["column_types"] = {
+            key: SQL_TYPES[type_] for key, type_ in column_types.items()
+        }
+    if create_indexes and progress.rows:
+        progress.details["indexes"] = await db.execute_write_fn(
+            lambda conn: create_recommended_indexes(conn, table_name, column_types),
+            block=True,
+        )
+
+
+async def import_csv_file_to_database(
+    filepath,
+    db,
+    table_name,
+    batch_size=DEFAULT_BATCH_SIZE,
+    progress=None,
+    encoding=None,
+    **options
+):
+    # Returns the number of rows that were imported
+    if progress is None:
+        progress = ImportProgress()
+    progress.total_bytes = os.path.getsize(filepath)
+    with open(filepath, "rb") as raw:
+        # Decompressed, then transcoded to UTF-8, as it is read
+        fp = TranscodedFile(open_decompressed(raw)[0], encoding)
+        await write_rows_to_table(
+            db,
+            table_name,
+            file_row_batches(fp, batch_size, progress, raw=raw),
+            progress,
+            **options
+        )
+    progress.finish()
+    return progress.rows
+
+
+def _parse_file_worker(index, filepath, batch_size, queue, stopped, encoding=None):
+    """
+    Runs in a worker process: parses filepath and puts (index, rows, offset)
+    tuples on queue, then (index, None, error) once the file is finished.
+    Gives up if the stopped event is set while waiting for room on queue.
+    """
+    import queue as queue_module
+    from sqlite_utils.utils import rows_from_file
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=WORKER_POLL_INTERVAL)
+                return True
+            except queue_module.Full:
+                pass
+        return False
+
+    try:
+        with open(filepath, "rb") as raw:
+            fp = TranscodedFile(open_decompressed(raw)[0], encoding)
+            rows = iter(rows_from_file(fp)[0])
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                # rows_from_file() closes the file once it has been fully read
+                offset = None if fp.closed else raw.tell()
+                if not put((index, batch, offset)):
+                    return
+    except Exception as e:
+        put((index, None, "{}: {}".format(type(e).__name__, e)))
+    else:
+        put((index, None, None))
+
+
+def parse_workers(num_files):
+    return max(min(num_files, os.cpu_count() or 1), 1)
+
+
+_parse_processes = {}
+_parse_processes_lock = threading.Lock()
+
+
+def parse_processes():
+    """
+    Returns the (manager, pool) used to parse files for imports, starting
+    them the first time - they are shared by every import after that
+
+    This blocks while the processes start, so call it from a thread.
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    with _parse_processes_lock:
+        if "pool" not in _parse_processes:
+            # spawn rather than fork - forking a process that is running
+            # threads, like Datasette's SQL threads, is not safe
+            context = multiprocessing.get_context("spawn")
+            if "manager" not in _parse_processes:
+                _parse_processes["manager"] = context.Manager()
+            _parse_processes["pool"] = concurrent.futures.ProcessPoolExecutor(
+                os.cpu_count() or 1, mp_context=context
+            )
+        return _parse_processes["manager"], _parse_processes["pool"]
+
+
+def discard_parse_pool(pool):
+    "Called when a worker process has died, which breaks the whole pool"
+    with _parse_processes_lock:
+        if _parse_processes.get("pool") is pool:
+            del _parse_processes["pool"]
+    pool.shutdown(wait=False)
+
+
+async def import_csv_files_to_database(
+    filepaths,
+    db,
+    table_names,
+    batch_size=DEFAULT_BATCH_SIZE,
+    progress=None,
+    create_indexes=False,
+    fast=False,
+    encoding=None,
+):
+    """
+    Imports several CSV, TSV or JSON files at once, parsing them in parallel
+    in a pool of worker processes. The workers send batches of rows through
+    a bounded queue to this coroutine, which is the only writer - SQLite
+    only allows one writer per database anyway.
+
+    table_names is a list with the table to write each file into - the same
+    table can be used for more than one file. Returns a list of dictionaries
+    describing what happened to each file. fast works as it does for
+    write_rows_to_table(), for every table being written to.
+    """
+    import concurrent.futures.process
+    import queue as queue_module
+    import sqlite_utils
+
+    if progress is None:
+        progress = ImportProgress()
+    sizes = [os.path.getsize(filepath) for filepath in filepaths]
+    progress.total_bytes = sum(sizes)
+    offsets = [0] * len(filepaths)
+    results = [
+        {"file": filepath, "ok": True, "table": table_name, "rows": 0}
+        for filepath, table_name in zip(filepaths, table_names)
+    ]
+    loop = asyncio.get_event_loop()
+    fast_imports = []
+    stopped = None
+    futures = []
+    try:
+        if fast:
+            for table_name in dict.fromkeys(table_names):
+                fast_import = FastImport(db, table_name)
+                await db.execute_write_fn(fast_import.start, block=True)
+                fast_imports.append(fast_import)
+
+        def start_workers():
+            # Starting the manager and worker processes waits for new Python
+            # interpreters to start up, so this runs in a thread
+            manager, pool = parse_processes()
+            queue = manager.Queue(QUEUED_BATCHES * parse_workers(len(filepaths)))
+            stopped = manager.Event()
+
+            def submit(pool):
+                return [
+                    pool.submit(
+                        _parse_file_worker,
+                        index,
+                        filepath,
+                        batch_size,
+                        queue,
+                        stopped,
+                        encoding,
+                    )
+                    for index, filepath in enumerate(filepaths)
+                ]
+
+            try:
+                futures = submit(pool)
+            except concurrent.futures.process.BrokenProcessPool:
+                # A worker process died while the pool was not being used
+                discard_parse_pool(pool)
+                pool = parse_processes()[1]
+                futures = submit(pool)
+            return pool, queue, stopped, futures
+
+        pool, queue, stopped, futures = await loop.run_in_executor(None, start_workers)
+        remaining = set(range(len(filepaths)))
+
+        def file_finished(index, error):
+            remaining.discard(index)
+            offsets[index] = sizes[index]
+            if error is not None:
+                results[index].update({"ok": False, "error": error})
+            progress.bytes_read = sum(offsets)
+
+        while remaining:
+            try:
+                index, batch, info = await loop.run_in_executor(
+                    None, queue.get, True, WORKER_POLL_INTERVAL
+                )
+            except queue_module.Empty:
+                # A worker process that died will never finish its file
+                for index, future in enumerate(futures):
+                    if index in remaining and future.done() and future.exception():
+                        exception = future.exception()
+                        file_finished(
+                            index, "{}: {}".format(type(exception).__name__, exception)
+                        )
+                        if isinstance(
+                            exception, concurrent.futures.process.BrokenProcessPool
+                        ):
+                            discard_parse_pool(pool)
+                continue
+            if index not in remaining:
+                continue
+            if batch is None:
+                file_finished(index, info)
+                continue
+            table_name = table_names[index]
+
+            def _write(conn):
+                sqlite_utils.Database(conn)[table_name].insert_all(
+                    batch, batch_size=len(batch)
+                )
+
+            await db.execute_write_fn(_write, block=True)
+            offsets[index] = sizes[index] if info is None else info
+            progress.bytes_read = sum(offsets)
+            progress.rows += len(batch)
+            progress.batches += 1
+            results[index]["rows"] += len(batch)
+    except BaseException:
+        for fast_import in fast_imports:
+            try:
+                await db.execute_write_fn(fast_import.rollback, block=True)
+            finally:
+                await db.execute_write_fn(fast_import.finish, block=True)
+        raise
+    finally:
+        # Workers that are waiting to start or for room on the queue give up
+        for future in futures:
+            future.cancel()
+        if stopped is not None:
+            stopped.set()
+    for fast_import in fast_imports:
+        await db.execute_write_fn(fast_import.finish, block=True)
+    if create_indexes:
+        indexes = {}
+        for table_name in dict.fromkeys(table_names):
+            if await db.table_exists(table_name):
+                indexes[table_name] = await db.execute_write_fn(
+                    lambda conn: create_recommended_indexes(conn, table_name),
+                    block=True,
+                )
+        progress.details["indexes"] = indexes
+    progress.finish()
+    return results
@@ -0,0 +1,78 @@
+from .importer import ImportProgress
+import asyncio
+import secrets
+
+# Finished jobs beyond this many are forgotten, oldest first
+MAX_FINISHED_JOBS = 100
+
+
+class ImportJob:
+    def __init__(self, path=None):
+        self.id = secrets.token_hex(8)
+        self.path = path
+        self.progress = ImportProgress()
+        self.status = "running"
+        self.error = None
+        self.result = {}
+        self.task = None
+
+    @property
+    def done(self):
+        return self.status != "running"
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.task.cancel()
+        return True
+
+    async def _run(self, fn):
+        try:
+            self.result = await fn(self.progress) or {}
+            self.status = "complete"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e)
+        finally:
+            self.progress.finish()
+
+    def _task_done(self, task):
+        # Catches jobs that were cancelled before they started running
+        if task.cancelled():
+            self.status = "cancelled"
+            self.progress.finish()
+
+    def as_dict(self):
+        info = {
+            "id": self.id,
+            "status": self.status,
+            "path": self.path,
+            "error": self.error,
+        }
+        info.update(self.progress.as_dict())
+        info.update(self.result)
+        return info
+
+
+def import_jobs(datasette):
+    if not hasattr(datasette, "_app_support_import_jobs"):
+        datasette._app_support_import_jobs = {}
+    return datasette._app_support_import_jobs
+
+
+def start_import_job(datasette, fn, path=None):
+    """
+    Run fn(progress) as a background task, returning the ImportJob that
+    tracks it. fn should update the ImportProgress it is passed.
+    """
+    jobs = import_jobs(datasette)
+    finished = [job_id for job_id, job in jobs.items() if job.done]
+    for job_id in finished[: max(len(finished) - MAX_FINISHED_JOBS + 1, 0)]:
+        jobs.pop(job_id)
+    job = ImportJob(path=path)
+    job.task = asyncio.ensure_future(job._run(fn))
+    job.task.add_done_callback(job._task_done)
+    jobs[job.id] = job
+    return job
@@ -0,0 +1,279 @@
+import asyncio
+import hashlib
+import json
+import os
+from .dates import prettydate
+from .temporary import add_scratch_database
+from .template_vars import invalidate_template_vars, register_template_var
+from .utils import user_cache_dir
+
+PLUGINS_URL = "https://datasette.io/content/plugins.json?_shape=array&_size=max"
+
+
+def default_cache_path():
+    "A file in the per-user cache directory for this platform"
+    return os.path.join(user_cache_dir(), "plugin-directory.json")
+
+
+def cache_path():
+    # The Electron app can set this to a file in its application data directory
+    return os.environ.get("DATASETTE_PLUGIN_DIRECTORY_CACHE") or default_cache_path()
+
+
+def load_cache():
+    path = cache_path()
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as fp:
+            cache = json.load(fp)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or not isinstance(cache.get("plugins"), list):
+        return {}
+    return cache
+
+
+def save_cache(cache):
+    path = cache_path()
+    # Write to a temporary file first so a crash can't leave half a cache behind
+    tmp_path = path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "w") as fp:
+            json.dump(cache, fp)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+async def annotate_plugins(datasette, plugins):
+    from packaging import version
+
+    # Annotate with list of installed plugins
+    installed_plugins = {
+        plugin["name"]: plugin["version"]
+        for plugin in (await datasette.client.get("/-/plugins.json")).json()
+    }
+    default_plugins = (os.environ.get("DATASETTE_DEFAULT_PLUGINS") or "").split()
+    for plugin in plugins:
+        is_installed = plugin["name"] in installed_plugins
+        installed_version = installed_plugins.get(plugin["name"])
+        plugin["installed"] = "installed" if is_installed else "not installed"
+        plugin["installed_version"] = installed_version
+        plugin["upgrade"] = (
+            "upgrade available"
+            if (
+                is_installed
+                and installed_version
+                and (
+                    version.parse(installed_version)
+                    < version.parse(plugin.get("tag_name", ""))
+                )
+            )
+            else None
+        )
+        plugin["is_default"] = plugin["name"] in default_plugins
+        # Formatted once here, rather than every time the directory is shown
+        plugin["latest_release_display"] = (
+            prettydate(plugin["latest_release_at"])
+            if plugin.get("latest_release_at")
+            else None
+        )
+    return plugins
+
+
+PLUGIN_COLUMNS = {
+    "name": str,
+    "full_name": str,
+    "owner": str,
+    "description": str,
+    "stargazers_count": int,
+    "tag_name": str,
+    "latest_release_at": str,
+    "created_at": str,
+    "openGraphImageUrl": str,
+    "usesCustomOpenGraphImage": int,
+    "downloads_this_week": int,
+    "is_plugin": int,
+    "is_tool": int,
+    "installed": str,
+    "installed_version": str,
+    "upgrade": str,
+    "is_default": int,
+    "latest_release_display": str,
+}
+SEARCH_COLUMNS = ("full_name", "name", "description")
+# Columns the directory is sorted by, and the facets it always shows
+SORT_COLUMNS = ("stargazers_count", "downloads_this_week", "latest_release_at")
+FACET_COLUMNS = ("installed", "upgrade")
+FACET_COUNTS_TABLE = "plugin_facet_counts"
+
+
+def _create_plugins_table(db):
+    db[FACET_COUNTS_TABLE].drop(ignore=True)
+    db["plugins"].create(PLUGIN_COLUMNS, pk="full_name")
+    # Triggers keep the search index in step with the upserts below
+    db["plugins"].enable_fts(SEARCH_COLUMNS, create_triggers=True)
+    for column in SORT_COLUMNS + FACET_COLUMNS:
+        db["plugins"].create_index([column])
+    db[FACET_COUNTS_TABLE].create(
+        {"facet": str, "value": str, "count": int}, pk=("facet", "value")
+    )
+
+
+def _update_facet_counts(conn):
+    conn.execute("delete from [{}]".format(FACET_COUNTS_TABLE))
+    for column in FACET_COLUMNS:
+        conn.execute(
+            "insert into [{}] (facet, value, count) "
+            "select ?, [{}], count(*) from plugins "
+            "where [{}] is not null group by [{}]".format(
+                FACET_COUNTS_TABLE, column, column, column
+            ),
+            [column],
+        )
+
+
+async def write_plugins(datasette, plugins):
+    """
+    Brings the plugins table in line with plugins - inserting new plugins,
+    updating only those that have changed and deleting any that have gone
+    """
+    import sqlite_utils
+
+    plugins = await annotate_plugins(datasette, [dict(p) for p in plugins])
+
+    def _write(conn):
+        db = sqlite_utils.Database(conn)
+        if not plugins:
+            # An empty table without search, for when there is no connection
+            for table in ("plugins", "plugins_fts", FACET_COUNTS_TABLE):
+                db[table].drop(ignore=True)
+            db["plugins"].create(PLUGIN_COLUMNS)
+            return
+        if not db["plugins_fts"].exists():
+            db["plugins"].drop(ignore=True)
+            _create_plugins_table(db)
+        existing = {
+            row["full_name"]: row for row in db["plugins"].rows_where(select="*")
+        }
+        changed = [
+            plugin
+            for plugin in plugins
+            if plugin["full_name"] not in existing
+            or any(
+                existing[plugin["full_name"]].get(key) != value
+                for key, value in plugin.items()
+            )
+        ]
+        removed = set(existing) - {plugin["full_name"] for plugin in plugins}
+        with conn:
+            if changed:
+                db["plugins"].upsert_all(changed, pk="full_name", alter=True)
+            for full_name in removed:
+                conn.execute("delete from plugins where full_name = ?", [full_name])
+            _update_facet_counts(conn)
+
+    await datasette.get_database("plugin_directory").execute_write_fn(
+        _write, block=True
+    )
+    invalidate_template_vars(datasette, *PLUGIN_TEMPLATE_VARS)
+
+
+@register_template_var("total_plugin_count")
+async def total_plugin_count(datasette):
+    return (
+        await datasette.get_database("plugin_directory").execute(
+            "select count(*) from plugins"
+        )
+    ).single_value()
+
+
+@register_template_var("plugin_upgrades_available", templates=("index.html",))
+async def plugin_upgrades_available(datasette):
+    db = datasette.get_database("plugin_directory")
+    if not await db.table_exists(FACET_COUNTS_TABLE):
+        return 0
+    return (
+        await db.execute(
+            "select coalesce(sum(count), 0) from [{}] "
+            "where facet = 'upgrade'".format(FACET_COUNTS_TABLE)
+        )
+    ).single_value()
+
+
+@register_template_var(
+    "plugin_facet_counts", templates=("table-plugin_directory-plugins.html",)
+)
+async def plugin_facet_counts(datasette):
+    "{facet: [(value, count), ...]} - shown by the directory instead of ?_facet="
+    db = datasette.get_database("plugin_directory")
+    counts = {column: [] for column in FACET_COLUMNS}
+    if not await db.table_exists(FACET_COUNTS_TABLE):
+        return counts
+    for row in await db.execute(
+        "select facet, value, count from [{}] "
+        "order by count desc, value".format(FACET_COUNTS_TABLE)
+    ):
+        counts[row["facet"]].append((row["value"], row["count"]))
+    return counts
+
+
+# Cached template variables that depend on the plugins table
+PLUGIN_TEMPLATE_VARS = (
+    "total_plugin_count",
+    "plugin_upgrades_available",
+    "plugin_facet_counts",
+)
+
+
+async def refresh_plugin_directory(datasette, cache):
+    "Fetch plugins.json, re-writing the plugins table only if it has changed"
+    import httpx
+
+    headers = {}
+    if cache.get("etag"):
+        headers["if-none-match"] = cache["etag"]
+    if cache.get("last_modified"):
+        headers["if-modified-since"] = cache["last_modified"]
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(PLUGINS_URL, headers=headers, timeout=10)
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+        plugins = response.json()
+    except (httpx.HTTPError, ValueError):
+        return False
+    if not isinstance(plugins, list):
+        return False
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    changed = content_hash != cache.get("hash")
+    save_cache(
+        {
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+            "hash": content_hash,
+            "plugins": plugins,
+        }
+    )
+    if changed:
+        await write_plugins(datasette, plugins)
+    return changed
+
+
+async def setup_plugin_directory(datasette):
+    """
+    Populate plugin_directory from the on-disk cache straight away, then
+    refresh it from datasette.io in the background
+    """
+    cache = load_cache()
+    # Not a shared-cache memory database, where pages being rendered would
+    # fail with "database table is locked" while the refresh below writes to
+    # it - in WAL mode readers carry on reading the previous version
+    add_scratch_database(datasette, "plugin_directory", journal_mode="wal")
+    await write_plugins(datasette, cache.get("plugins") or [])
+    datasette._app_support_plugin_directory_refresh = asyncio.ensure_future(
+        refresh_plugin_directory(datasette, cache)
+    )
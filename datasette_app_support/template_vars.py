@@ -0,0 +1,64 @@
+import collections
+
+# name: (async fn(datasette), templates or None for every template)
+TEMPLATE_VARS = {}
+
+
+def register_template_var(name, templates=None):
+    """
+    Decorator for an async function(datasette) that computes the template
+    variable name. The value is computed the first time a page needs it and
+    then cached until invalidate_template_vars() is called - so only use it
+    for values that can be recomputed when whatever they depend on changes.
+
+    templates is a tuple of template names, such as ("index.html",), to only
+    provide the variable when rendering those templates.
+    """
+
+    def decorator(fn):
+        TEMPLATE_VARS[name] = (fn, templates)
+        return fn
+
+    return decorator
+
+
+def _cache(datasette):
+    if not hasattr(datasette, "_app_support_template_vars"):
+        datasette._app_support_template_vars = {}
+    return datasette._app_support_template_vars
+
+
+def _generations(datasette):
+    # Bumped by each invalidation, so a value computed across one is not cached
+    if not hasattr(datasette, "_app_support_template_var_generations"):
+        datasette._app_support_template_var_generations = collections.Counter()
+    return datasette._app_support_template_var_generations
+
+
+def invalidate_template_vars(datasette, *names):
+    "Forget the cached values of names - or of every variable, if none are given"
+    cache = _cache(datasette)
+    generations = _generations(datasette)
+    if not names:
+        names = set(TEMPLATE_VARS) | set(cache)
+    for name in names:
+        cache.pop(name, None)
+        generations[name] += 1
+
+
+async def template_vars(datasette, template):
+    "Returns the registered variables for template, computing any not cached"
+    cache = _cache(datasette)
+    generations = _generations(datasette)
+    values = {}
+    for name, (fn, templates) in TEMPLATE_VARS.items():
+        if templates is not None and template not in templates:
+            continue
+        if name in cache:
+            values[name] = cache[name]
+            continue
+        generation = generations[name]
+        values[name] = await fn(datasette)
+        if generations[name] == generation:
+            cache[name] = values[name]
+    return values
@@ -0,0 +1,231 @@
+from .databases import attach_database_files, path_registry
+from datasette.database import Database
+from datasette.utils import sqlite3
+import asyncio
+import atexit
+import os
+import pathlib
+import tempfile
+
+# Pages copied per step of the online backup, and the pause between steps
+# that lets other connections use the database
+BACKUP_PAGES_PER_STEP = 1024
+BACKUP_STEP_SLEEP = 0.005
+MAX_BACKUP_RESTARTS = 3
+
+
+def temporary_memory_limit():
+    "Returns DATASETTE_TEMPORARY_MEMORY_LIMIT_MB as a number of bytes, or None"
+    limit = os.environ.get("DATASETTE_TEMPORARY_MEMORY_LIMIT_MB")
+    if not limit:
+        return None
+    try:
+        limit = float(limit)
+    except ValueError:
+        return None
+    if limit <= 0:
+        return None
+    return int(limit * 1024 * 1024)
+
+
+def add_temporary_database(datasette):
+    """
+    Adds the temporary database - in memory, unless a memory limit has been
+    configured with the DATASETTE_TEMPORARY_MEMORY_LIMIT_MB environment
+    variable.
+
+    With a limit, temporary lives in a scratch file that is deleted on exit,
+    and every commit writes its pages to that file. Each connection gets a
+    share of the limit as its SQLite page cache, which caps how much of the
+    database is kept in memory for reading it.
+    """
+    limit = temporary_memory_limit()
+    if limit is None:
+        return datasette.add_memory_database("temporary")
+    # One write connection plus one read connection per SQL thread
+    connections = (datasette.setting("num_sql_threads") or 1) + 1
+    datasette._app_support_temporary_cache_kib = max(limit // 1024 // connections, 1)
+    return add_scratch_database(datasette, "temporary")
+
+
+def add_scratch_database(datasette, name, journal_mode=None):
+    "Adds a mutable database backed by a new file that is deleted on exit"
+    fd, scratch_path = tempfile.mkstemp(
+        prefix="datasette-{}-".format(name), suffix=".db"
+    )
+    os.close(fd)
+    atexit.register(_remove_scratch_file, scratch_path)
+    if journal_mode:
+        conn = sqlite3.connect(scratch_path)
+        conn.execute("pragma journal_mode = {}".format(journal_mode))
+        conn.close()
+    db = Database(datasette, path=scratch_path, is_mutable=True)
+    # Not a file the user opened, so left out of the path registry
+    db._app_support_scratch = True
+    return datasette.add_database(db, name=name)
+
+
+def _remove_scratch_file(path):
+    for suffix in ("", "-journal", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+
+
+def prepare_temporary_connection(conn, datasette):
+    cache_kib = getattr(datasette, "_app_support_temporary_cache_kib", None)
+    if cache_kib is None:
+        return
+    # Negative cache_size is in KiB. The scratch file is thrown away on exit,
+    # so commits skip the syncing and journal writes that make them durable.
+    conn.execute("pragma cache_size = -{}".format(int(cache_kib)))
+    conn.execute("pragma synchronous = off")
+    conn.execute("pragma journal_mode = memory")
+    conn.execute("pragma temp_store = memory")
+
+
+def backup_to_file(conn, filepath, progress=None, pages=None):
+    """
+    Copies the database open on conn to filepath using SQLite's online
+    backup API, a few pages at a time
+
+    The copy is written to a temporary file which then replaces filepath,
+    so an interrupted backup never leaves a half-written file behind.
+    progress(pages_copied, total_pages) is called after each step.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filepath)), suffix=".tmp"
+    )
+    os.close(fd)
+    dest = sqlite3.connect(tmp_path)
+
+    def _progress(status, remaining, total):
+        if progress is not None:
+            progress(total - remaining, total)
+
+    try:
+        conn.backup(
+            dest,
+            pages=pages or BACKUP_PAGES_PER_STEP,
+            progress=_progress,
+            sleep=BACKUP_STEP_SLEEP,
+        )
+    except Exception:
+        dest.close()
+        os.remove(tmp_path)
+        raise
+    dest.close()
+    os.replace(tmp_path, filepath)
+
+
+class BackupRestarted(Exception):
+    pass
+
+
+async def dump_temporary(datasette, filepath, progress=None):
+    """
+    Backs up the temporary database to filepath from a read connection,
+    so writes to temporary can continue while the dump is running
+
+    SQLite restarts a backup whenever another connection writes to the
+    source database. If that keeps happening the dump falls back to running
+    on the write connection, which blocks writes but is never restarted.
+    """
+    db = datasette.get_database("temporary")
+
+    def _dump(conn):
+        page_size = conn.execute("pragma page_size").fetchone()[0]
+        restarts = 0
+        last_copied = 0
+
+        def on_progress(copied, total):
+            nonlocal restarts, last_copied
+            if copied < last_copied:
+                restarts += 1
+                if restarts > MAX_BACKUP_RESTARTS:
+                    raise BackupRestarted()
+            last_copied = copied
+            if progress is not None:
+                progress.bytes_read = copied * page_size
+                progress.total_bytes = total * page_size
+
+        backup_to_file(conn, filepath, progress=on_progress)
+
+    try:
+        await db.execute_fn(_dump)
+    except BackupRestarted:
+        await db.execute_write_fn(_dump, block=True)
+    if progress is not None:
+        progress.finish()
+
+
+async def restore_temporary(datasette, filepath, progress=None):
+    """
+    Replaces the contents of temporary with the database at filepath
+
+    This runs on temporary's write thread, copying a batch of pages per
+    backup step and updating progress as it goes. Returns the list of
+    tables in the backup.
+    """
+    temporary = datasette.get_database("temporary")
+    uri = pathlib.Path(filepath).resolve().as_uri() + "?mode=ro"
+
+    def _restore(conn):
+        source = sqlite3.connect(uri, uri=True)
+        try:
+            page_size = source.execute("pragma page_size").fetchone()[0]
+
+            def on_progress(status, remaining, total):
+                if progress is not None:
+                    progress.bytes_read = (total - remaining) * page_size
+                    progress.total_bytes = total * page_size
+
+            source.backup(conn, pages=BACKUP_PAGES_PER_STEP, progress=on_progress)
+            return [
+                r[0]
+                for r in source.execute(
+                    "select name from sqlite_master where type='table'"
+                ).fetchall()
+            ]
+        finally:
+            source.close()
+
+    backup_tables = await temporary.execute_write_fn(_restore, block=True)
+    if progress is not None:
+        progress.finish()
+    return backup_tables
+
+
+async def attach_snapshot(datasette, filepath):
+    """
+    Instead of copying a large snapshot into temporary, attaches it as its
+    own read-only database. Returns (error, Database) - error is a message
+    if it is not a valid SQLite database or is already open.
+    """
+    result = (await attach_database_files(datasette, [filepath], read_only=True))[0]
+    if not result["ok"]:
+        return result["error"], None
+    return None, datasette.get_database(path_registry(datasette).find(filepath))
+
+
+async def _autosave_loop(datasette, filepath, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await dump_temporary(datasette, filepath)
+        except Exception:
+            # Try again next time - the app should keep running regardless
+            pass
+
+
+def schedule_autosave(datasette, filepath, interval):
+    "Dumps temporary to filepath every interval seconds - or stops if interval is 0"
+    existing = getattr(datasette, "_app_support_autosave", None)
+    if existing is not None:
+        existing.cancel()
+        datasette._app_support_autosave = None
+    if interval:
+        datasette._app_support_autosave = asyncio.ensure_future(
+            _autosave_loop(datasette, filepath, interval)
+        )
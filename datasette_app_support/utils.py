@@ -1,88 +1,719 @@
-import sqlite_utils
-from csv import DictReader
+from .charsets import TextDecoder
+from .compression import DecompressedStream, strip_compression_extension
+from .importer import (
+    SQL_TYPES,
+    ImportProgress,
+    create_recommended_indexes,
+    sized_batches,
+    write_rows_to_table,
+)
+from datasette.utils import sqlite3
+import asyncio
+import collections
+import contextlib
+import csv
+import hashlib
 import io
-import httpx
+import json
+import os
+import pathlib
+import re
+import sys
+import tempfile
 import urllib
 
+# Records how far each import from a URL got, keyed by the database it went
+# into - kept out of that database so it never shows up as one of its tables
+URL_IMPORTS_SCHEMA = """
+create table if not exists url_imports (
+    database text,
+    url text,
+    table_name text,
+    status text,
+    etag text,
+    last_modified text,
+    bytes_offset integer,
+    rows integer,
+    base_rowid integer,
+    fieldnames text,
+    encoding text,
+    content_hash text,
+    primary key (database, url)
+)
+"""
+URL_IMPORTS_COLUMNS = (
+    "url",
+    "table_name",
+    "status",
+    "etag",
+    "last_modified",
+    "bytes_offset",
+    "rows",
+    "base_rowid",
+    "fieldnames",
+    "encoding",
+    "content_hash",
+)
 
-async def derive_table_name(db, table_name):
-    root_table_name = table_name
+
+def user_cache_dir():
+    "The directory for this plugin in the per-user cache directory for this platform"
+    if sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    elif sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~/AppData/Local")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "datasette-app-support")
+
+
+def next_free_table_name(conn, table_name, reserved=()):
+    """
+    Returns table_name, or the first of table_name_1, table_name_2... that is
+    not already in use or in reserved - using a single query
+
+    Tables, views and indexes share a namespace, and names are compared
+    case-insensitively, just like SQLite does.
+    """
+    pattern = (
+        table_name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        + "\\_%"
+    )
+    taken = {
+        row[0].lower()
+        for row in conn.execute(
+            "select name from sqlite_master where name = ? collate nocase "
+            "or name like ? escape '\\'",
+            [table_name, pattern],
+        )
+    }
+    taken.update(name.lower() for name in reserved)
+    if table_name.lower() not in taken:
+        return table_name
     i = 1
-    while await db.table_exists(table_name):
-        table_name = "{}_{}".format(root_table_name, i)
+    while "{}_{}".format(table_name, i).lower() in taken:
         i += 1
-    return table_name
+    return "{}_{}".format(table_name, i)
+
+
+def _reserved_table_names(db):
+    if not hasattr(db, "_app_support_reserved_tables"):
+        db._app_support_reserved_tables = set()
+    return db._app_support_reserved_tables
+
+
+async def reserve_table_name(db, table_name):
+    """
+    Returns next_free_table_name() for table_name and reserves it until it
+    is passed to release_table_names() - so imports running at the same time
+    never pick the same name
+
+    This runs on the write thread, which is also where the import creates
+    the table, so a name cannot be taken between being picked and used.
+    """
+    reserved = _reserved_table_names(db)
+
+    def _reserve(conn):
+        name = next_free_table_name(conn, table_name, reserved)
+        reserved.add(name)
+        return name
+
+    return await db.execute_write_fn(_reserve, block=True)
+
+
+def release_table_names(db, *table_names):
+    reserved = _reserved_table_names(db)
+    for table_name in table_names:
+        reserved.discard(table_name)
+
+
+class _RecordScanner:
+    """
+    Finds the end of the last complete record in a growing buffer of CSV
+    text, scanning each character only once across calls
+
+    A quote character only starts a quoted field at the start of a field,
+    as it does for the csv module - one anywhere else, like 5'10", is part
+    of the value. Newlines inside quoted fields do not end a record.
 
+    Both states are matched by a compiled pattern, so a chunk is scanned
+    without any Python code running per field.
+    """
 
-class AsyncDictReader:
-    def __init__(self, async_line_iterator):
-        self.async_line_iterator = async_line_iterator
-        self.buffer = io.StringIO()
-        self.reader = DictReader(self.buffer)
+    def __init__(self, dialect):
+        if isinstance(dialect, str):
+            dialect = csv.get_dialect(dialect)
+        self.quotechar = dialect.quotechar
+        self.escapechar = dialect.escapechar
+        self.doublequote = dialect.doublequote
+        if dialect.quoting == csv.QUOTE_NONE or not self.quotechar:
+            self.outside = self.inside = None
+        else:
+            quote = re.escape(self.quotechar)
+            separators = re.escape(dialect.delimiter) + r"\r\n"
+            # The text of a quoted field, up to the quote that may close it -
+            # unrolled so runs of ordinary characters are matched in one go
+            text = "[^{}{}]*".format(quote, re.escape(self.escapechar or ""))
+            escapes = []
+            if self.escapechar:
+                escapes.append(r"{}[\s\S]".format(re.escape(self.escapechar)))
+            if self.doublequote:
+                escapes.append(quote * 2)
+            content = text
+            if escapes:
+                content += "(?:(?:{}){})*".format("|".join(escapes), text)
+            self.inside = re.compile(content)
+            # The rest of a line outside quotes, including whole quoted fields
+            # whose closing quote is followed by something that shows it is
+            # one - each part can only match one way, so this never
+            # backtracks far when a line stops at a quoted field still open
+            line = (
+                r"[^{q}\n]*(?:(?:(?<=[^{s}]){q}"
+                r"|(?:(?<=[{s}])|\A){q}{content}{q}(?={after}))[^{q}\n]*)*"
+            ).format(
+                q=quote,
+                s=separators,
+                content=content,
+                after=r"[^{}]".format(quote) if self.doublequote else r"[\s\S]",
+            )
+            self.outside = re.compile(
+                r"(?P<records>(?:{line}\n)*){line}".format(line=line)
+            )
+        self.position = 0
+        self.in_quotes = False
+        self.boundary = 0
+
+    def __call__(self, buffer):
+        "Returns the index just past the last newline that ends a record, or 0"
+        if self.outside is None:
+            return buffer.rfind("\n") + 1
+        position, length = self.position, len(buffer)
+        while position < length:
+            if self.in_quotes:
+                end = self.inside.match(buffer, position).end()
+                if end >= length or (self.doublequote and end + 1 >= length):
+                    # Wait for more text to see how this quoted field ends
+                    self.position = end
+                    return self.boundary
+                if buffer[end] != self.quotechar:
+                    # An escape character at the end of the buffer
+                    self.position = end
+                    return self.boundary
+                self.in_quotes = False
+                position = end + 1
+                continue
+            match = self.outside.match(buffer, position)
+            if match.end("records") > position:
+                self.boundary = match.end("records")
+            end = match.end()
+            if end < length:
+                # Stopped at a quote starting a field that has not closed yet
+                self.in_quotes = True
+                end += 1
+            position = end
+        self.position = position
+        return self.boundary
+
+    def discard(self, length):
+        "Call after removing the first length characters of the buffer"
+        self.position -= length
+        self.boundary = 0
+
+
+class AsyncCSVReader:
+    """
+    Incrementally parses CSV from an async iterator of byte chunks, such
+    as httpx's response.aiter_bytes()
+
+    Iterating over this yields lists of row dictionaries - one list for
+    each chunk that completed at least one record. Quoted fields that
+    contain newlines and multi-byte characters that are split across
+    chunks are both handled correctly.
+
+    The encoding is detected from the start of the data unless one is
+    passed - see TextDecoder. After each list is yielded, offset is the
+    number of bytes up to the end of the last complete record, or None if
+    that cannot be known, and rows_read is the number of rows so far. Pass
+    the fieldnames from an earlier reader to parse data that starts part
+    way through a file.
+    """
+
+    def __init__(
+        self,
+        async_byte_iterator,
+        encoding=None,
+        dialect="excel",
+        fieldnames=None,
+        strict=None,
+    ):
+        self.async_byte_iterator = async_byte_iterator
+        self.decoder = TextDecoder(encoding, strict=strict)
+        self.dialect = dialect
+        self.fieldnames = fieldnames
+        self.buffer = ""
+        self._scan = _RecordScanner(dialect)
         self.line_num = 0
+        self.bytes_fed = 0
+        self.offset = 0
+        self.rows_read = 0
 
     def __aiter__(self):
-        return self
+        return self._batches()
 
-    async def __anext__(self):
-        if self.line_num == 0:
-            header = await self.async_line_iterator.__anext__()
-            self.buffer.write(header)
+    async def _batches(self):
+        async for chunk in self.async_byte_iterator:
+            self.bytes_fed += len(chunk)
+            rows = self._feed(self.decoder.decode(chunk))
+            if rows:
+                self._update_offset(rows)
+                yield rows
+        rows = self._feed(self.decoder.decode(b"", final=True), final=True)
+        if rows:
+            self._update_offset(rows)
+            yield rows
 
-        line = await self.async_line_iterator.__anext__()
+    def _update_offset(self, rows):
+        buffered = self.decoder.encoded_length(self.buffer)
+        if buffered is None or self.offset is None:
+            self.offset = None
+        else:
+            self.offset = self.bytes_fed - self.decoder.pending_bytes() - buffered
+        self.rows_read += len(rows)
 
-        if not line:
-            raise StopAsyncIteration
+    def _feed(self, text, final=False):
+        self.buffer += text
+        if final:
+            boundary = len(self.buffer)
+        else:
+            boundary = self._scan(self.buffer)
+        if not boundary:
+            return []
+        complete, self.buffer = self.buffer[:boundary], self.buffer[boundary:]
+        self._scan.discard(boundary)
+        return self._parse(complete)
 
-        self.buffer.write(line)
-        self.buffer.seek(0)
+    def _parse(self, text):
+        reader = csv.reader(io.StringIO(text, newline=""), self.dialect)
+        if self.fieldnames is None:
+            for values in reader:
+                self.line_num += 1
+                if values:
+                    self.fieldnames = values
+                    break
+        fieldnames = self.fieldnames
+        num_fields = len(fieldnames or ())
+        rows = []
+        for values in reader:
+            self.line_num += 1
+            if len(values) != num_fields:
+                if not values:
+                    continue
+                if len(values) > num_fields:
+                    raise ValueError(
+                        "Row {} has {} fields, expected {}".format(
+                            self.line_num, len(values), num_fields
+                        )
+                    )
+                values = values + [None] * (num_fields - len(values))
+            rows.append(dict(zip(fieldnames, values)))
+        return rows
 
-        try:
-            result = next(self.reader)
-        except StopIteration as e:
-            raise StopAsyncIteration from e
 
-        self.buffer.seek(0)
-        self.buffer.truncate(0)
-        self.line_num = self.reader.line_num
+async def _spool_and_hash(chunks, spool, progress):
+    "Writes chunks to the file spool, returning their SHA-256 hex digest"
+    hasher = hashlib.sha256()
+    async for chunk in chunks:
+        hasher.update(chunk)
+        spool.write(chunk)
+        progress.bytes_read = spool.tell()
+    return hasher.hexdigest()
 
-        return result
 
+async def _file_chunks(fp, chunk_size=64 * 1024):
+    "Yields the contents of fp in chunks, then closes it"
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, fp.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        fp.close()
 
-async def import_csv_url_to_database(url, db, requested_table_name=None):
-    # Returns table_name, num_rows
-    last_path_bit = urllib.parse.urlparse(url).path.split("/")[-1]
+
+def table_name_from_url(url):
+    last_path_bit = strip_compression_extension(
+        urllib.parse.urlparse(url).path.split("/")[-1]
+    )
     last_path_bit_minus_extension = last_path_bit.rsplit(".", 1)[0]
-    table_name = requested_table_name or (
-        await derive_table_name(db, last_path_bit_minus_extension or "data_from_csv")
+    return last_path_bit_minus_extension or "data_from_csv"
+
+
+def table_name_from_filepath(filepath):
+    "data.csv and data.csv.gz both become data"
+    return pathlib.Path(strip_compression_extension(filepath)).stem
+
+
+def url_imports_path():
+    # The Electron app can set this to a file in its application data directory
+    return os.environ.get("DATASETTE_URL_IMPORTS_DB") or os.path.join(
+        user_cache_dir(), "url-imports.db"
     )
 
-    async def write_batch(rows):
-        def _write(conn):
-            db_conn = sqlite_utils.Database(conn)
-            with db_conn.conn:
-                db_conn[table_name].insert_all(rows)
 
-        r = await db.execute_write_fn(_write, block=True)
-        return r
+def _url_imports_key(db):
+    # Files are identified by path, in-memory databases by name
+    return str(pathlib.Path(db.path).resolve()) if db.path else db.name
+
+
+def _url_imports_connection():
+    path = url_imports_path()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute(URL_IMPORTS_SCHEMA)
+    return conn
+
+
+def _url_import_state(database, url):
+    with contextlib.closing(_url_imports_connection()) as conn:
+        row = conn.execute(
+            "select {} from url_imports where database = ? and url = ?".format(
+                ", ".join(URL_IMPORTS_COLUMNS)
+            ),
+            [database, url],
+        ).fetchone()
+    if row is None:
+        return None
+    state = dict(zip(URL_IMPORTS_COLUMNS, row))
+    state["fieldnames"] = json.loads(state["fieldnames"] or "null")
+    return state
+
+
+def _save_url_import_state(database, state):
+    values = dict(state, fieldnames=json.dumps(state["fieldnames"]))
+    with contextlib.closing(_url_imports_connection()) as conn:
+        with conn:
+            conn.execute(
+                "insert or replace into url_imports (database, {}) "
+                "values (?, {})".format(
+                    ", ".join(URL_IMPORTS_COLUMNS),
+                    ", ".join("?" for _ in URL_IMPORTS_COLUMNS),
+                ),
+                [database] + [values[column] for column in URL_IMPORTS_COLUMNS],
+            )
+
+
+async def url_import_state(db, url):
+    """
+    Returns what is known about an earlier import of url into db - or None
+    if there was not one, or the table it was imported into has gone
+    """
+    state = await asyncio.get_event_loop().run_in_executor(
+        None, _url_import_state, _url_imports_key(db), url
+    )
+    if state is None or not await db.table_exists(state["table_name"]):
+        return None
+    return state
+
+
+async def import_csv_url_to_database(
+    url,
+    db,
+    requested_table_name=None,
+    progress=None,
+    resume=True,
+    encoding=None,
+    **options
+):
+    """
+    Imports the CSV file at url into a table, recording progress in the
+    url_imports_path() database as each batch is written
+
+    Importing the same URL again continues an interrupted import where it
+    left off, using an HTTP Range request, or returns the existing table
+    straight away if the file has not changed. If it has changed, the new
+    rows are imported into a new table which then replaces the old one.
+    Returns table_name, num_rows
+    """
+    reserved = []
+    if not requested_table_name:
+        requested_table_name = await reserve_table_name(db, table_name_from_url(url))
+        reserved.append(requested_table_name)
+    try:
+        return await _import_csv_url_to_database(
+            url,
+            db,
+            requested_table_name,
+            progress,
+            resume,
+            encoding,
+            reserved,
+            **options
+        )
+    finally:
+        release_table_names(db, *reserved)
+
+
+async def _import_csv_url_to_database(
+    url, db, table_name, progress, resume, encoding, reserved, **options
+):
+    import httpx
+    import sqlite_utils
+
+    if progress is None:
+        progress = ImportProgress()
+    if options.get("fast"):
+        # A failed fast import deletes its rows, so there is nothing to resume
+        resume = False
+    database = _url_imports_key(db)
+    state = await url_import_state(db, url)
+    if state is not None and state["table_name"] != table_name:
+        state = None
+    complete = state is not None and state["status"] == "complete"
+    validator = state and (state["etag"] or state["last_modified"])
+
+    headers = {}
+    if complete:
+        if state["etag"]:
+            headers["if-none-match"] = state["etag"]
+        if state["last_modified"]:
+            headers["if-modified-since"] = state["last_modified"]
+    elif state is not None and resume and validator and state["bytes_offset"]:
+        headers["range"] = "bytes={}-".format(state["bytes_offset"])
+        # The server should only send the rest of the file if it is unchanged
+        headers["if-range"] = validator
+
+    def unchanged():
+        progress.rows = state["rows"]
+        progress.details["unchanged"] = True
+        progress.finish()
+        return table_name, progress.rows
 
     async with httpx.AsyncClient() as client:
-        async with client.stream("GET", url, follow_redirects=True) as response:
-            reader = AsyncDictReader(response.aiter_lines())
-            batch = []
-            num_rows = 0
-            async for row in reader:
-                num_rows += 1
-                batch.append(row)
-                if len(batch) >= 100:
-                    # Write this batch to disk
-                    await write_batch(batch)
-                    batch = []
-            if batch:
-                await write_batch(batch)
-
-    import asyncio
-
-    await asyncio.sleep(1)
-
-    return table_name, num_rows
+        async with client.stream(
+            "GET", url, headers=headers, follow_redirects=True
+        ) as response:
+            if complete and response.status_code == 304:
+                return unchanged()
+            response.raise_for_status()
+            etag = response.headers.get("etag")
+            last_modified = response.headers.get("last-modified")
+            # Servers that ignore the conditional headers still send them
+            if complete and (
+                (etag and etag == state["etag"])
+                or (
+                    not etag
+                    and last_modified
+                    and last_modified == state["last_modified"]
+                )
+            ):
+                return unchanged()
+            content_hash = None
+            body = response.aiter_bytes()
+
+            def bytes_downloaded():
+                return response.num_bytes_downloaded
+
+            if complete and not etag and not last_modified and state["content_hash"]:
+                # Nothing says whether the file has changed, so hash it
+                # before writing anything - keeping a copy on disk to import
+                # from if it has
+                spool = tempfile.TemporaryFile()
+                content_hash = await _spool_and_hash(body, spool, progress)
+                if content_hash == state["content_hash"]:
+                    spool.close()
+                    return unchanged()
+                spool_size = spool.tell()
+                spool.seek(0)
+                body = _file_chunks(spool)
+
+                def bytes_downloaded():
+                    # _file_chunks() closes the spool once it has all been read
+                    return spool_size if spool.closed else spool.tell()
+
+            content_length = response.headers.get("content-length")
+            resuming = response.status_code == 206 and (
+                response.headers.get("content-range") or ""
+            ).startswith("bytes {}-".format(state["bytes_offset"]))
+
+            target = table_name
+            if resuming:
+                start_offset, start_rows = state["bytes_offset"], state["rows"]
+                base_rowid = state["base_rowid"]
+                fieldnames = state["fieldnames"]
+                # Carry on decoding the file the same way
+                resume_encoding = encoding or state.get("encoding")
+                progress.details["resumed"] = True
+
+                def _discard_unrecorded_rows(conn):
+                    # Rows written after the last recorded offset will be
+                    # read again
+                    with conn:
+                        conn.execute(
+                            "delete from [{}] where rowid > ?".format(table_name),
+                            [base_rowid + start_rows],
+                        )
+
+                await db.execute_write_fn(_discard_unrecorded_rows, block=True)
+            else:
+                start_offset, start_rows, fieldnames = 0, 0, None
+                resume_encoding = encoding
+                if complete:
+                    # Keep the old table available until the new one is ready
+                    target = await reserve_table_name(db, table_name + "_new")
+                    reserved.append(target)
+                elif state is not None:
+                    # An interrupted import that cannot be resumed
+                    await db.execute_write_fn(
+                        lambda conn: sqlite_utils.Database(conn)[table_name].drop(),
+                        block=True,
+                    )
+
+                def _max_rowid(conn):
+                    if not sqlite_utils.Database(conn)[target].exists():
+                        return 0
+                    return conn.execute(
+                        "select coalesce(max(rowid), 0) from [{}]".format(target)
+                    ).fetchone()[0]
+
+                base_rowid = await db.execute_write_fn(_max_rowid, block=True)
+            if content_length and content_length.isdigit():
+                progress.total_bytes = start_offset + int(content_length)
+            progress.rows = start_rows
+            progress.bytes_read = start_offset
+
+            hasher = None if (resuming or content_hash) else hashlib.sha256()
+            checkpoints = collections.deque()
+            new_state = {
+                "url": url,
+                "table_name": table_name,
+                "etag": etag,
+                "last_modified": last_modified,
+                "status": "partial",
+                "base_rowid": base_rowid,
+                "content_hash": None,
+            }
+
+            async def hashed_bytes():
+                async for chunk in body:
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    yield chunk
+
+            # Compressed files are decompressed as they stream in
+            stream = DecompressedStream(hashed_bytes())
+            reader = AsyncCSVReader(
+                stream,
+                encoding=resume_encoding,
+                fieldnames=fieldnames,
+                strict=encoding is not None,
+            )
+
+            async def row_lists():
+                async for rows in reader:
+                    progress.bytes_read = start_offset + bytes_downloaded()
+                    if reader.offset is not None:
+                        checkpoints.append(
+                            (
+                                start_rows + reader.rows_read,
+                                start_offset + reader.offset,
+                            )
+                        )
+                    yield rows
+
+            unresumable_saved = False
+
+            def after_write(conn, rows_written):
+                nonlocal unresumable_saved
+                checkpoint = None
+                while checkpoints and checkpoints[0][0] <= rows_written:
+                    checkpoint = checkpoints.popleft()
+                # Offsets into decompressed data cannot be resumed, and once
+                # the encoding has switched there are no offsets at all
+                if (
+                    not resume
+                    or stream.compression is not None
+                    or reader.offset is None
+                ):
+                    if unresumable_saved:
+                        return
+                    # Still recorded, so importing again replaces this table
+                    # instead of leaving it behind with part of the file
+                    checkpoint = (rows_written, None)
+                    unresumable_saved = True
+                if checkpoint is not None:
+                    _save_url_import_state(
+                        database,
+                        dict(
+                            new_state,
+                            rows=checkpoint[0],
+                            bytes_offset=checkpoint[1],
+                            fieldnames=reader.fieldnames,
+                            encoding=reader.decoder.encoding,
+                        ),
+                    )
+
+            # Indexes for a replacement table are created once it has been
+            # renamed, so that they are named after the table they end up on
+            deferred_indexes = target != table_name and options.pop(
+                "create_indexes", False
+            )
+
+            # Downloading and parsing run ahead of the writes, until the
+            # queue of parsed batches is full
+            await write_rows_to_table(
+                db,
+                target,
+                sized_batches(row_lists()),
+                progress,
+                # Progress on a replacement table is not worth resuming
+                after_write=after_write if target == table_name else None,
+                **options
+            )
+
+    if hasher is not None:
+        content_hash = hasher.hexdigest()
+    if target != table_name and content_hash == state["content_hash"]:
+        await db.execute_write_fn(
+            lambda conn: sqlite_utils.Database(conn)[target].drop(), block=True
+        )
+        return unchanged()
+
+    def _complete(conn):
+        if target != table_name:
+            with conn:
+                conn.execute("drop table [{}]".format(table_name))
+                conn.execute(
+                    "alter table [{}] rename to [{}]".format(target, table_name)
+                )
+        _save_url_import_state(
+            database,
+            dict(
+                new_state,
+                status="complete",
+                rows=progress.rows,
+                bytes_offset=(
+                    start_offset + reader.offset if reader.offset is not None else None
+                ),
+                fieldnames=reader.fieldnames,
+                encoding=reader.decoder.encoding,
+                content_hash=content_hash,
+            ),
+        )
+
+    await db.execute_write_fn(_complete, block=True)
+    if deferred_indexes and progress.rows:
+        column_types = None
+        if "column_types" in progress.details:
+            python_types = {sql: type_ for type_, sql in SQL_TYPES.items()}
+            column_types = {
+                key: python_types[sql]
+                for key, sql in progress.details["column_types"].items()
+            }
+        progress.details["indexes"] = await db.execute_write_fn(
+            lambda conn: create_recommended_indexes(conn, table_name, column_types),
+            block=True,
+        )
+    progress.finish()
+    return table_name, progress.rows
@@ -36,7 +36,10 @@ setup(
     },
     entry_points={"datasette": ["app_support = datasette_app_support"]},
     install_requires=["datasette>=0.59", "sqlite-utils", "packaging"],
-    extras_require={"test": ["pytest", "pytest-asyncio", "black", "pytest-httpx"]},
+    extras_require={
+        "test": ["pytest", "pytest-asyncio", "black", "pytest-httpx"],
+        "zstd": ["zstandard"],
+    },
     tests_require=["datasette-app-support[test]"],
     python_requires=">=3.6",
 )
@@ -1,18 +1,29 @@
 from unittest import mock
+import httpx
 import os
 import pytest
 
+PLUGINS_URL = "https://datasette.io/content/plugins.json?_shape=array&_size=max"
+
 
 @pytest.fixture(autouse=True)
-def mock_settings_env_vars():
-    with mock.patch.dict(os.environ, {"DATASETTE_API_TOKEN": "fake-token"}):
+def mock_settings_env_vars(tmpdir):
+    with mock.patch.dict(
+        os.environ,
+        {
+            "DATASETTE_API_TOKEN": "fake-token",
+            # Keep tests from reading or writing the real per-user cache
+            "DATASETTE_PLUGIN_DIRECTORY_CACHE": str(tmpdir / "plugin-directory.json"),
+            "DATASETTE_URL_IMPORTS_DB": str(tmpdir / "url-imports.db"),
+        },
+    ):
         yield
 
 
 @pytest.fixture(autouse=True)
 def mock_datasette_plugin_api(httpx_mock):
     httpx_mock.add_response(
-        url="https://datasette.io/content/plugins.json?_shape=array&_size=max",
+        url=PLUGINS_URL,
         json=[
             {
                 "name": "datasette-write",
@@ -31,6 +42,12 @@ def mock_datasette_plugin_api(httpx_mock):
             }
         ],
     )
+    yield
+    # The plugin directory is refreshed in the background, and some tests
+    # never start Datasette, so this is the one mocked response that may go
+    # unrequested - request it here so pytest-httpx still checks the rest
+    if not httpx_mock.get_requests(url=PLUGINS_URL):
+        httpx.get(PLUGINS_URL)
 
 
 @pytest.fixture
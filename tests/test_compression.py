@@ -0,0 +1,226 @@
+from datasette.app import Datasette
+from datasette_app_support.compression import (
+    MAX_DECOMPRESSED_CHUNK,
+    CompressionError,
+    DecompressedStream,
+    strip_compression_extension,
+)
+import bz2
+import gzip
+import io
+import lzma
+import pytest
+import sqlite3
+import zipfile
+
+CSV = b"id,name\n" + b"".join(
+    "{},Name {}\n".format(i, i).encode("utf-8") for i in range(2000)
+)
+
+
+def _zip(data, compression=zipfile.ZIP_DEFLATED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=compression) as zf:
+        zf.writestr("data.csv", data)
+    return buffer.getvalue()
+
+
+async def _chunks(data, size):
+    for i in range(0, len(data), size):
+        yield data[i : i + size]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "compress,expected",
+    (
+        (lambda data: data, None),
+        (gzip.compress, "gzip"),
+        # Concatenated gzip streams are read as one file
+        (lambda data: gzip.compress(data[:1000]) + gzip.compress(data[1000:]), "gzip"),
+        (bz2.compress, "bz2"),
+        (lzma.compress, "xz"),
+        (_zip, "zip"),
+        (lambda data: _zip(data, zipfile.ZIP_STORED), "zip"),
+    ),
+)
+@pytest.mark.parametrize("size", (3, 1000))
+async def test_decompressed_stream(compress, expected, size):
+    stream = DecompressedStream(_chunks(compress(CSV), size))
+    output = b""
+    async for chunk in stream:
+        assert stream.compression == expected
+        output += chunk
+    assert output == CSV
+
+
+def _zip_members(*names, compression=zipfile.ZIP_DEFLATED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=compression) as zf:
+        for name in names:
+            # Names ending in / are directories
+            zf.writestr(name, "" if name.endswith("/") else CSV)
+    return buffer.getvalue()
+
+
+def _streamed_zip(data):
+    # Written to an unseekable file, so sizes go in data descriptors
+    class Unseekable(io.RawIOBase):
+        def __init__(self):
+            self.written = b""
+
+        def writable(self):
+            return True
+
+        def write(self, b):
+            self.written += bytes(b)
+            return len(b)
+
+    output = Unseekable()
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        with zf.open("data.csv", "w") as fp:
+            fp.write(data)
+    return output.written
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", (3, 1000))
+@pytest.mark.parametrize(
+    "data",
+    (
+        _zip_members("folder/", "folder/data.csv"),
+        _zip_members("data.csv", "empty/"),
+        _streamed_zip(CSV),
+    ),
+)
+async def test_decompressed_stream_zip_layouts(data, size):
+    output = b"".join(
+        [chunk async for chunk in DecompressedStream(_chunks(data, size))]
+    )
+    assert output == CSV
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "data,expected_error",
+    (
+        (
+            _zip_members("data.csv", compression=zipfile.ZIP_BZIP2),
+            "Zip files must use deflate compression",
+        ),
+        (
+            _zip_members("one.csv", "two.csv"),
+            "Zip files must contain exactly one file",
+        ),
+        (
+            _zip_members("one.csv", "two.csv", compression=zipfile.ZIP_STORED),
+            "Zip files must contain exactly one file",
+        ),
+        (_zip_members("empty/"), "Zip files must contain exactly one file"),
+        (_zip(CSV)[:1000], "Zip file ended unexpectedly"),
+    ),
+)
+async def test_decompressed_stream_zip_errors(data, expected_error):
+    with pytest.raises(CompressionError) as e:
+        async for chunk in DecompressedStream(_chunks(data, 100)):
+            pass
+    assert str(e.value) == expected_error
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compress", (gzip.compress, bz2.compress, lzma.compress, _zip))
+async def test_decompressed_stream_limits_chunk_size(compress):
+    # 16MB of zeros compresses to a single small chunk
+    data = b"\0" * (16 * 1024 * 1024)
+    compressed = compress(data)
+    assert len(compressed) < 1024 * 1024
+    total = 0
+    async for chunk in DecompressedStream(_chunks(compressed, len(compressed))):
+        assert len(chunk) <= MAX_DECOMPRESSED_CHUNK
+        total += len(chunk)
+    assert total == len(data)
+
+
+@pytest.mark.parametrize(
+    "name,expected",
+    (
+        ("data.csv.gz", "data.csv"),
+        ("data.csv.ZST", "data.csv"),
+        ("data.zip", "data"),
+        ("data.csv", "data.csv"),
+    ),
+)
+def test_strip_compression_extension(name, expected):
+    assert strip_compression_extension(name) == expected
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "filename,compress",
+    (
+        ("data.csv.gz", gzip.compress),
+        ("data.csv.bz2", bz2.compress),
+        ("data.csv.xz", lzma.compress),
+        ("data.zip", _zip),
+    ),
+)
+async def test_import_compressed_csv_file(tmpdir, filename, compress):
+    db_path = str(tmpdir / "import.db")
+    sqlite3.connect(db_path).execute("vacuum")
+    datasette = Datasette([db_path], memory=True)
+    await datasette.invoke_startup()
+    path = str(tmpdir / filename)
+    open(path, "wb").write(compress(CSV))
+    response = await datasette.client.post(
+        "/-/import-csv-file",
+        json={"path": path, "database": "import"},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    # Plus elapsed and rows_per_second
+    assert (
+        response.json().items()
+        >= {"ok": True, "path": "/import/data", "rows": 2000}.items()
+    )
+    # The same file through the parallel importer
+    response2 = await datasette.client.post(
+        "/-/import-csv-files",
+        json={"paths": [path], "database": "import"},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response2.json()["files"][0]["table"] == "data_1"
+    assert response2.json()["rows"] == 2000
+
+
+@pytest.mark.asyncio
+async def test_import_compressed_csv_url(httpx_mock):
+    httpx_mock.add_response(
+        url="http://example.com/export.csv.gz",
+        content=gzip.compress(CSV),
+        headers={"etag": '"v1"'},
+    )
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    db = datasette.get_database("temporary")
+    if await db.table_exists("export"):
+        await db.execute_write("drop table export", block=True)
+    response = await datasette.client.post(
+        "/-/open-csv-from-url",
+        json={"url": "http://example.com/export.csv.gz"},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    # Plus elapsed and rows_per_second
+    assert (
+        response.json().items()
+        >= {"ok": True, "path": "/temporary/export", "rows": 2000}.items()
+    )
+
+
+@pytest.mark.asyncio
+async def test_decompressed_stream_zstd():
+    zstandard = pytest.importorskip("zstandard")
+    data = zstandard.ZstdCompressor().compress(CSV)
+    stream = DecompressedStream(_chunks(data, 100))
+    assert b"".join([chunk async for chunk in stream]) == CSV
+    assert stream.compression == "zstd"
@@ -0,0 +1,20 @@
+from datasette_app_support.dates import prettydate
+import datetime
+import pytest
+
+
+@pytest.mark.parametrize(
+    "date,expected",
+    (
+        ("2021-09-11T05:59:43Z", "11th September 2021"),
+        ("2021-09-01T05:59:43+01:00", "1st September 2021"),
+        ("2021-09-22", "22nd September 2021"),
+        ("2021-09-13", "13th September 2021"),
+        # Falls back to dateutil for anything that is not ISO 8601
+        ("3 Sep 2021", "3rd September 2021"),
+        ("not a date", "not a date"),
+        (datetime.date(2021, 9, 11), "11th September 2021"),
+    ),
+)
+def test_prettydate(date, expected):
+    assert prettydate(date) == expected
@@ -1,5 +1,8 @@
 from datasette.app import Datasette
 from datasette.utils import sqlite3
+from unittest import mock
+import asyncio
+import os
 import pytest
 
 
@@ -60,3 +63,219 @@ async def test_restore_temporary_from_file(tmpdir):
     # Check the restore
     response2 = await datasette.client.get("/temporary/backup_restored")
     assert response2.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_dump_temporary_to_file_autosave(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    backup_path = str(tmpdir / "autosave.db")
+    temporary = datasette.get_database("temporary")
+    await temporary.execute_write("create table autosaved (id integer primary key)")
+    response = await datasette.client.post(
+        "/-/dump-temporary-to-file",
+        json={"path": backup_path, "autosave": 0.05},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"ok": True, "path": backup_path, "autosave": 0.05}
+    # Changes are picked up by the next autosave
+    await temporary.execute_write("insert into autosaved (id) values (1)")
+    for _ in range(50):
+        await asyncio.sleep(0.05)
+        conn = sqlite3.connect(backup_path)
+        rows = conn.execute("select id from autosaved").fetchall()
+        conn.close()
+        if rows:
+            break
+    assert rows == [(1,)]
+    # autosave: 0 turns it off again
+    response2 = await datasette.client.post(
+        "/-/dump-temporary-to-file",
+        json={"path": backup_path, "autosave": 0},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response2.json() == {"ok": True, "path": backup_path}
+    assert datasette._app_support_autosave is None
+
+
+@pytest.mark.asyncio
+async def test_dump_temporary_to_file_background(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    temporary = datasette.get_database("temporary")
+    await temporary.execute_write_script(
+        "create table big (id integer primary key, data text);"
+        "insert into big (data) select randomblob(1000) from ("
+        "  with recursive c(x) as (select 1 union all select x + 1 from c limit 2000)"
+        "  select x from c"
+        ");"
+    )
+    backup_path = str(tmpdir / "background.db")
+    response = await datasette.client.post(
+        "/-/dump-temporary-to-file",
+        json={"path": backup_path, "background": True},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    job_path = response.json()["job_path"]
+    for _ in range(100):
+        job = (
+            await datasette.client.get(
+                job_path, headers={"Authorization": "Bearer fake-token"}
+            )
+        ).json()
+        if job["status"] != "running":
+            break
+        await asyncio.sleep(0.05)
+    assert job["status"] == "complete"
+    assert job["bytes_read"] == job["total_bytes"]
+    assert job["total_bytes"] > 2000 * 1000
+    conn = sqlite3.connect(backup_path)
+    assert conn.execute("select count(*) from big").fetchone()[0] == 2000
+
+
+@pytest.mark.asyncio
+async def test_restore_temporary_from_file_background(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    backup_path = str(tmpdir / "restore_background.db")
+    conn = sqlite3.connect(backup_path)
+    conn.execute("create table restored_in_background (id integer primary key)")
+    conn.execute("insert into restored_in_background (id) values (1)")
+    conn.commit()
+    conn.close()
+    response = await datasette.client.post(
+        "/-/restore-temporary-from-file",
+        json={"path": backup_path, "background": True},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    job_path = response.json()["job_path"]
+    for _ in range(100):
+        job = (
+            await datasette.client.get(
+                job_path, headers={"Authorization": "Bearer fake-token"}
+            )
+        ).json()
+        if job["status"] != "running":
+            break
+        await asyncio.sleep(0.05)
+    assert job["status"] == "complete"
+    assert job["backup_tables"] == ["restored_in_background"]
+    assert "restored_in_background" in job["restored_tables"]
+    assert job["bytes_read"] == job["total_bytes"] == 8192
+
+
+@pytest.mark.asyncio
+async def test_restore_temporary_from_file_attach(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    backup_path = str(tmpdir / "snapshot.db")
+    conn = sqlite3.connect(backup_path)
+    conn.execute("create table snapshot_table (id integer primary key)")
+    conn.close()
+    response = await datasette.client.post(
+        "/-/restore-temporary-from-file",
+        json={"path": backup_path, "mode": "attach"},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "ok": True,
+        "path": backup_path,
+        "attached": "/snapshot",
+        "backup_tables": ["snapshot_table"],
+    }
+    snapshot = datasette.get_database("snapshot")
+    # Served without Datasette hashing the whole file on the event loop
+    with mock.patch(
+        "datasette.database.inspect_hash", side_effect=AssertionError("hashed")
+    ):
+        for path in (
+            "/",
+            "/-/databases.json",
+            "/snapshot",
+            "/snapshot/snapshot_table.json",
+        ):
+            response2 = await datasette.client.get(path)
+            assert response2.status_code == 200
+    assert snapshot.cached_hash is None
+    # And it is never written to
+    with pytest.raises(sqlite3.OperationalError):
+        await snapshot.execute_write("insert into snapshot_table (id) values (1)")
+    # Nothing was copied into temporary
+    assert (
+        "snapshot_table" not in await datasette.get_database("temporary").table_names()
+    )
+
+
+@pytest.mark.asyncio
+async def test_restore_temporary_from_file_attach_errors(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    not_sqlite = str(tmpdir / "not-sqlite.db")
+    open(not_sqlite, "w").write("This is not a SQLite database " * 10)
+    snapshot = str(tmpdir / "snapshot.db")
+    sqlite3.connect(snapshot).execute("create table t (id integer)")
+    databases = set(datasette.databases)
+    responses = []
+    for path in (not_sqlite, snapshot, snapshot):
+        responses.append(
+            await datasette.client.post(
+                "/-/restore-temporary-from-file",
+                json={"path": path, "mode": "attach"},
+                headers={"Authorization": "Bearer fake-token"},
+            )
+        )
+    assert [r.status_code for r in responses] == [400, 200, 400]
+    assert responses[0].json() == {
+        "ok": False,
+        "error": "Not a valid SQLite database",
+    }
+    assert responses[2].json() == {"ok": False, "error": "That file is already open"}
+    # Only the valid snapshot was attached, once
+    assert set(datasette.databases) - databases == {"snapshot"}
+
+
+@pytest.mark.asyncio
+async def test_temporary_memory_limit(tmpdir):
+    with mock.patch.dict(os.environ, {"DATASETTE_TEMPORARY_MEMORY_LIMIT_MB": "4"}):
+        datasette = Datasette([], memory=True)
+        await datasette.invoke_startup()
+    temporary = datasette.get_database("temporary")
+    # Backed by a scratch file, with the limit shared between connections
+    assert temporary.path and os.path.exists(temporary.path)
+    assert temporary.is_mutable
+    cache_size = (await temporary.execute("pragma cache_size")).single_value()
+    assert cache_size == -(4 * 1024 // 4)
+    path = str(tmpdir / "limited.csv")
+    open(path, "w").write("id,name\n1,Cleo\n")
+    response = await datasette.client.post(
+        "/-/open-csv-file",
+        json={"path": path},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert (
+        response.json().items()
+        >= {
+            "ok": True,
+            "path": "/temporary/limited",
+            "rows": 1,
+        }.items()
+    )
+    # Dump and restore still work
+    backup_path = str(tmpdir / "limited-backup.db")
+    response2 = await datasette.client.post(
+        "/-/dump-temporary-to-file",
+        json={"path": backup_path},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response2.status_code == 200
+    await temporary.execute_write("drop table limited")
+    response3 = await datasette.client.post(
+        "/-/restore-temporary-from-file",
+        json={"path": backup_path},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response3.json()["restored_tables"] == ["limited"]
+    response4 = await datasette.client.get("/temporary/limited.json?_shape=array")
+    assert response4.json() == [{"rowid": 1, "id": "1", "name": "Cleo"}]
@@ -0,0 +1,109 @@
+from datasette.app import Datasette
+from datasette_app_support.jobs import start_import_job
+import asyncio
+import pytest
+
+
+async def _wait_for_job(datasette, job_path):
+    for _ in range(100):
+        response = await datasette.client.get(
+            job_path, headers={"Authorization": "Bearer fake-token"}
+        )
+        if response.json()["status"] != "running":
+            return response
+        await asyncio.sleep(0.05)
+    assert False, "Job did not finish"
+
+
+@pytest.mark.asyncio
+async def test_open_csv_file_background(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    path = str(tmpdir / "jobs_demo.csv")
+    open(path, "w").write("id,name\n1,Cleo\n2,Pancakes\n")
+    response = await datasette.client.post(
+        "/-/open-csv-file",
+        json={"path": path, "background": True},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["ok"] is True
+    assert data["path"] == "/temporary/jobs_demo"
+    assert data["job_path"] == "/-/import-jobs/{}".format(data["job"])
+    response2 = await _wait_for_job(datasette, data["job_path"])
+    job = response2.json()
+    assert (
+        job.items()
+        >= {
+            "ok": True,
+            "id": data["job"],
+            "status": "complete",
+            "path": "/temporary/jobs_demo",
+            "error": None,
+            "rows": 2,
+            "bytes_read": 26,
+            "total_bytes": 26,
+            "eta": 0,
+        }.items()
+    )
+    assert job["rows_per_second"] > 0
+
+
+@pytest.mark.asyncio
+async def test_import_job_failed(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    path = str(tmpdir / "bad_jobs.csv")
+    open(path, "wb").write(b"id,name\n1,S\xe3o Paulo\n")
+    response = await datasette.client.post(
+        "/-/open-csv-file",
+        json={"path": path, "background": True, "encoding": "utf-8"},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    response2 = await _wait_for_job(datasette, response.json()["job_path"])
+    assert response2.json()["status"] == "failed"
+    assert "can't decode byte 0xe3" in response2.json()["error"]
+
+
+@pytest.mark.asyncio
+async def test_cancel_import_job():
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+
+    async def slow_import(progress):
+        await asyncio.sleep(10)
+
+    job = start_import_job(datasette, slow_import, path="/temporary/slow")
+    response = await datasette.client.post(
+        "/-/import-jobs/{}/cancel".format(job.id),
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"ok": True, "id": job.id}
+    await asyncio.wait([job.task])
+    response2 = await datasette.client.get(
+        "/-/import-jobs/{}".format(job.id),
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response2.json()["status"] == "cancelled"
+    # Cancelling again is an error
+    response3 = await datasette.client.post(
+        "/-/import-jobs/{}/cancel".format(job.id),
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response3.status_code == 400
+    assert response3.json() == {"ok": False, "error": "Job has already finished"}
+
+
+@pytest.mark.asyncio
+async def test_import_job_not_found():
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    response = await datasette.client.get(
+        "/-/import-jobs/abc123", headers={"Authorization": "Bearer fake-token"}
+    )
+    assert response.status_code == 404
+    assert response.json() == {"ok": False, "error": "Job not found"}
+    response2 = await datasette.client.get("/-/import-jobs/abc123")
+    assert response2.status_code == 401
@@ -0,0 +1,45 @@
+import subprocess
+import sys
+
+# Modules that are slow to import, which should only be loaded by the
+# routes and hooks that need them
+HEAVY_MODULES = (
+    "dateutil",
+    "httpx",
+    "multiprocessing",
+    "packaging",
+    "sqlite_utils",
+    "zstandard",
+)
+# The parts of Datasette that are imported when this plugin is loaded.
+# Anything these import is not a cost of this plugin.
+DATASETTE_IMPORTS = "import datasette.database, datasette.utils.asgi"
+# Deliberately generous, so this only fails on a large regression
+IMPORT_TIME_BUDGET_SECONDS = 0.5
+
+
+def _import_times(code):
+    "Returns {module: cumulative microseconds} from python -X importtime"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit():
+            times.setdefault(module.strip(), int(cumulative))
+    return times
+
+
+def test_import_time():
+    baseline = _import_times(DATASETTE_IMPORTS)
+    times = _import_times(DATASETTE_IMPORTS + "; import datasette_app_support")
+    added = set(times) - set(baseline)
+    heavy = sorted(module for module in added if module.split(".")[0] in HEAVY_MODULES)
+    assert heavy == []
+    assert times["datasette_app_support"] < IMPORT_TIME_BUDGET_SECONDS * 1000000
@@ -0,0 +1,115 @@
+from datasette.app import Datasette
+from datasette_app_support.importer import (
+    FastImport,
+    infer_column_types,
+    queued_batches,
+    sized_batches,
+    value_type,
+)
+import pytest
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "width,expected_sizes",
+    (
+        # 10 byte rows, 1000 byte target = 100 row batches
+        (10, [100, 100, 100, 100, 100, 50]),
+        # Very wide rows still get the minimum batch size
+        (5000, [50] * 11),
+        # 1 byte rows are capped at 250 rows per batch
+        (1, [250, 250, 50]),
+    ),
+)
+async def test_sized_batches(width, expected_sizes, monkeypatch):
+    monkeypatch.setattr("datasette_app_support.importer.MIN_SIZED_BATCH", 50)
+    monkeypatch.setattr("datasette_app_support.importer.MAX_SIZED_BATCH", 250)
+    row_lists = [[{"v": "x" * width}] * 110 for _ in range(5)]
+    sizes = [
+        len(batch)
+        async for batch in sized_batches(_aiter(row_lists), target_bytes=1000)
+    ]
+    assert sizes == expected_sizes
+    assert sum(sizes) == 550
+
+
+@pytest.mark.asyncio
+async def test_queued_batches():
+    batches = [[1, 2], [3], [4, 5, 6]]
+    assert [b async for b in queued_batches(_aiter(batches), maxsize=1)] == batches
+
+
+@pytest.mark.asyncio
+async def test_queued_batches_error():
+    async def failing():
+        yield [1]
+        raise ValueError("Bad row")
+
+    seen = []
+    with pytest.raises(ValueError) as e:
+        async for batch in queued_batches(failing()):
+            seen.append(batch)
+    assert seen == [[1]]
+    assert str(e.value) == "Bad row"
+
+
+def test_infer_column_types():
+    rows = [
+        {"id": "1", "score": "1.5", "zip": "02134", "name": "Cleo", "empty": ""},
+        {"id": "-20", "score": "3", "zip": "94107", "name": "1", "empty": None},
+        {"id": "", "score": "1e3", "zip": "10001", "name": "2", "empty": ""},
+        {"id": 3, "score": 2.5, "zip": "12345", "name": "3"},
+    ]
+    assert infer_column_types(rows) == {
+        "id": int,
+        "score": float,
+        "zip": str,
+        "name": str,
+        "empty": str,
+    }
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    (
+        ("0", int),
+        ("12345678901234567890", str),
+        ("1.", float),
+        (".5", float),
+        ("-1.5E-3", float),
+        ("nan", str),
+        ("0x10", str),
+        ("007", str),
+        (True, int),
+        ({"a": 1}, str),
+    ),
+)
+def test_value_type(value, expected):
+    assert value_type(value) is expected
+
+
+@pytest.mark.asyncio
+async def test_fast_imports_that_overlap(tmpdir):
+    datasette = Datasette([str(tmpdir / "data.db")])
+    db = datasette.get_database("data")
+
+    def pragmas(conn):
+        return [
+            conn.execute("pragma {}".format(pragma)).fetchone()[0]
+            for pragma in ("synchronous", "cache_size")
+        ]
+
+    original = await db.execute_write_fn(pragmas, block=True)
+    first, second = FastImport(db, "one"), FastImport(db, "two")
+    await db.execute_write_fn(first.start, block=True)
+    await db.execute_write_fn(second.start, block=True)
+    # The first to finish leaves the settings relaxed for the other
+    await db.execute_write_fn(first.finish, block=True)
+    assert await db.execute_write_fn(pragmas, block=True) == [0, -262144]
+    await db.execute_write_fn(second.finish, block=True)
+    assert await db.execute_write_fn(pragmas, block=True) == original
@@ -1,5 +1,7 @@
 from datasette.app import Datasette
+from datasette.utils import sqlite3
 import pytest
+import sqlite_utils
 
 
 @pytest.mark.asyncio
@@ -27,3 +29,98 @@ async def test_new_empty_database_file(tmpdir):
     )
     assert response2.status_code == 400
     assert response2.json() == {"error": "That file already exists", "ok": False}
+
+
+@pytest.mark.asyncio
+async def test_new_empty_database_file_options(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    path = str(tmpdir / "tuned.db")
+    response = await datasette.client.post(
+        "/-/new-empty-database-file",
+        json={
+            "path": path,
+            "page_size": 16384,
+            "journal_mode": "wal",
+            "auto_vacuum": "incremental",
+            "schema": "create table notes (id integer primary key, body text);",
+        },
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"ok": True, "path": "/tuned"}
+    conn = sqlite3.connect(path)
+    assert conn.execute("pragma page_size").fetchone()[0] == 16384
+    assert conn.execute("pragma journal_mode").fetchone()[0] == "wal"
+    # 2 means incremental
+    assert conn.execute("pragma auto_vacuum").fetchone()[0] == 2
+    assert [
+        r[0] for r in conn.execute("select name from sqlite_master where type='table'")
+    ] == ["notes"]
+
+
+@pytest.mark.asyncio
+async def test_new_empty_database_file_template(tmpdir):
+    template = str(tmpdir / "template.db")
+    db = sqlite_utils.Database(template)
+    db["items"].insert({"id": 1, "name": "One"}, pk="id")
+    db["items"].create_index(["name"])
+    db["items"].enable_fts(["name"], create_triggers=True)
+    db.create_view("item_names", "select name from items")
+    db.close()
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    path = str(tmpdir / "from_template.db")
+    response = await datasette.client.post(
+        "/-/new-empty-database-file",
+        json={"path": path, "template": template},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    new_db = sqlite_utils.Database(path)
+    assert set(new_db.table_names()) == set(
+        sqlite_utils.Database(template).table_names()
+    )
+    assert new_db.view_names() == ["item_names"]
+    assert new_db["items"].count == 0
+    assert [index.columns for index in new_db["items"].indexes] == [["name"]]
+    # The FTS triggers were copied too
+    new_db["items"].insert({"id": 2, "name": "Two"})
+    assert list(new_db["items"].search("Two")) == [{"rowid": 2, "id": 2, "name": "Two"}]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "body,expected_error",
+    (
+        ({"page_size": 1000}, "page_size must be a power of two between 512 and 65536"),
+        (
+            {"journal_mode": "fast"},
+            "journal_mode must be one of: delete, wal",
+        ),
+        (
+            # Only lasts as long as the connection that sets it
+            {"journal_mode": "memory"},
+            "journal_mode must be one of: delete, wal",
+        ),
+        ({"schema": "create tabel"}, 'Could not create database: near "tabel"'),
+        (
+            {"template": "/does/not/exist.db"},
+            "template must be the path to a SQLite database",
+        ),
+        ({"schema": "", "template": ""}, "Use either 'schema' or 'template', not both"),
+    ),
+)
+async def test_new_empty_database_file_invalid_options(tmpdir, body, expected_error):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    path = str(tmpdir / "invalid.db")
+    response = await datasette.client.post(
+        "/-/new-empty-database-file",
+        json=dict(body, path=path),
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 400
+    assert response.json()["error"].startswith(expected_error)
+    # A file that could not be set up is not left behind
+    assert not (tmpdir / "invalid.db").exists()
@@ -1,6 +1,22 @@
 from datasette.app import Datasette
+from datasette_app_support.importer import _parse_file_worker, parse_processes
+from datasette_app_support.utils import url_import_state
+from unittest import mock
+import asyncio
+import gzip
+import httpx
+import os
 import pytest
+import signal
 import sqlite3
+import threading
+
+
+def _without_throughput(data):
+    # Timings vary from run to run, so are checked and then removed
+    assert data.pop("elapsed") >= 0
+    assert data.pop("rows_per_second") >= 0
+    return data
 
 
 @pytest.mark.asyncio
@@ -15,7 +31,15 @@ async def test_open_csv_files(tmpdir):
         headers={"Authorization": "Bearer fake-token"},
     )
     assert response.status_code == 200
-    assert response.json() == {"ok": True, "path": "/temporary/demo", "rows": 1}
+    data = response.json()
+    # Throughput is reported for imports that do not run in the background
+    assert data["elapsed"] > 0
+    assert data["rows_per_second"] > 0
+    assert _without_throughput(data) == {
+        "ok": True,
+        "path": "/temporary/demo",
+        "rows": 1,
+    }
     response2 = await datasette.client.get("/temporary/demo.json?_shape=array")
     assert response2.json() == [{"rowid": 1, "id": "123", "name": "Hello"}]
 
@@ -28,16 +52,57 @@ async def test_open_csv_files_invalid_csv(tmpdir):
     open(path, "wb").write(
         b"date,name,latitude,longitude\n" b"2020-03-04,S\xe3o Paulo,-23.561,-46.645\n"
     )
+    await _reset_temporary(datasette)
+    # The encoding is detected as cp1252, which is a superset of Latin-1
     response = await datasette.client.post(
         "/-/open-csv-file",
         json={"path": path},
         headers={"Authorization": "Bearer fake-token"},
     )
+    assert response.status_code == 200
+    assert _without_throughput(response.json()) == {
+        "ok": True,
+        "path": "/temporary/bad",
+        "rows": 1,
+    }
+    response2 = await datasette.client.get("/temporary/bad.json?_shape=array")
+    assert response2.json()[0]["name"] == "S\u00e3o Paulo"
+
+
+@pytest.mark.asyncio
+async def test_open_csv_files_explicit_encoding(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    await _reset_temporary(datasette)
+    path = str(tmpdir / "latin1.csv")
+    open(path, "wb").write(
+        b"date,name,latitude,longitude\n" b"2020-03-04,S\xe3o Paulo,-23.561,-46.645\n"
+    )
+    # An explicit encoding is not second-guessed
+    response = await datasette.client.post(
+        "/-/open-csv-file",
+        json={"path": path, "encoding": "utf-8"},
+        headers={"Authorization": "Bearer fake-token"},
+    )
     assert response.status_code == 500
     assert response.json() == {
         "ok": False,
         "error": "'utf-8' codec can't decode byte 0xe3 in position 41: invalid continuation byte",
     }
+    response2 = await datasette.client.post(
+        "/-/open-csv-file",
+        json={"path": path, "encoding": "latin-1"},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response2.status_code == 200
+    assert response2.json()["rows"] == 1
+    response3 = await datasette.client.post(
+        "/-/open-csv-file",
+        json={"path": path, "encoding": "klingon"},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response3.status_code == 400
+    assert response3.json() == {"ok": False, "error": "Unknown encoding: klingon"}
 
 
 @pytest.mark.asyncio
@@ -54,7 +119,11 @@ async def test_import_csv_files(tmpdir):
         headers={"Authorization": "Bearer fake-token"},
     )
     assert response.status_code == 200
-    assert response.json() == {"ok": True, "path": "/data/demo", "rows": 1}
+    assert _without_throughput(response.json()) == {
+        "ok": True,
+        "path": "/data/demo",
+        "rows": 1,
+    }
     response2 = await datasette.client.get("/data/demo.json?_shape=array")
     assert response2.json() == [{"rowid": 1, "id": "123", "name": "Hello"}]
 
@@ -93,7 +162,7 @@ async def test_import_csv_url(
         headers={"Authorization": "Bearer fake-token"},
     )
     assert response.status_code == 200
-    assert response.json() == {
+    assert _without_throughput(response.json()) == {
         "ok": True,
         "path": "/temporary/{}".format(expected_table_name),
         "rows": 2,
@@ -113,3 +182,623 @@ async def _reset_temporary(datasette):
     db = datasette.get_database("temporary")
     for table in await db.table_names():
         await db.execute_write("drop table [{}]".format(table))
+
+
+@pytest.mark.asyncio
+async def test_import_csv_file_batch_size(tmpdir):
+    db_path = str(tmpdir / "data.db")
+    sqlite3.connect(db_path).execute("vacuum")
+    datasette = Datasette([db_path], memory=True)
+    await datasette.invoke_startup()
+    path = str(tmpdir / "many.csv")
+    with open(path, "w") as fp:
+        fp.write("id,name\n")
+        for i in range(25):
+            fp.write("{},Name {}\n".format(i, i))
+    response = await datasette.client.post(
+        "/-/import-csv-file",
+        json={"path": path, "database": "data", "batch_size": 10},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    assert _without_throughput(response.json()) == {
+        "ok": True,
+        "path": "/data/many",
+        "rows": 25,
+    }
+    assert (
+        sqlite3.connect(db_path).execute("select count(*) from many").fetchone()[0]
+        == 25
+    )
+    # Invalid batch sizes are rejected
+    response2 = await datasette.client.post(
+        "/-/import-csv-file",
+        json={"path": path, "database": "data", "batch_size": 0},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response2.status_code == 400
+    assert response2.json() == {
+        "ok": False,
+        "error": "batch_size must be an integer between 1 and 100000",
+    }
+
+
+@pytest.mark.asyncio
+async def test_open_csv_file_detect_types(tmpdir, monkeypatch):
+    monkeypatch.setattr("datasette_app_support.importer.DETECT_TYPES_SAMPLE", 3)
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    await _reset_temporary(datasette)
+    path = str(tmpdir / "typed.csv")
+    open(path, "w").write(
+        "id,height,zip,name\n"
+        "1,1.5,02134,Cleo\n"
+        "2,,94107,Pancakes\n"
+        "3,2,10001,Stacey\n"
+        # After the sample - does not match the detected types
+        "unknown,tall,12345,Bo\n"
+    )
+    response = await datasette.client.post(
+        "/-/open-csv-file",
+        json={"path": path, "detect_types": True, "batch_size": 1},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    assert _without_throughput(response.json()) == {
+        "ok": True,
+        "path": "/temporary/typed",
+        "rows": 4,
+        "column_types": {
+            "id": "INTEGER",
+            "height": "REAL",
+            "zip": "TEXT",
+            "name": "TEXT",
+        },
+    }
+    db = datasette.get_database("temporary")
+    rows = (
+        await db.execute("select id, typeof(id), height, zip from typed order by rowid")
+    ).rows
+    assert [tuple(row) for row in rows] == [
+        (1, "integer", 1.5, "02134"),
+        (2, "integer", None, "94107"),
+        (3, "integer", 2.0, "10001"),
+        ("unknown", "text", "tall", "12345"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_import_csv_file_create_indexes(tmpdir):
+    db_path = str(tmpdir / "data.db")
+    sqlite3.connect(db_path).execute("vacuum")
+    datasette = Datasette([db_path], memory=True)
+    await datasette.invoke_startup()
+    path = str(tmpdir / "creatures.csv")
+    with open(path, "w") as fp:
+        fp.write("id,species,weight,name\n")
+        for i in range(300):
+            fp.write(
+                "{},{},{},{}\n".format(
+                    i, ("dog", "cat", "pelican")[i % 3], i * 1.5, "Name {}".format(i)
+                )
+            )
+    response = await datasette.client.post(
+        "/-/import-csv-file",
+        json={
+            "path": path,
+            "database": "data",
+            "detect_types": True,
+            "create_indexes": True,
+        },
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    # species is a facet, id and weight are numeric, name is neither
+    assert data["indexes"] == [
+        "idx_creatures_species",
+        "idx_creatures_id",
+        "idx_creatures_weight",
+    ]
+    conn = sqlite3.connect(db_path)
+    assert conn.execute(
+        "select idx from sqlite_stat1 where tbl = 'creatures' order by idx"
+    ).fetchall() == [
+        ("idx_creatures_id",),
+        ("idx_creatures_species",),
+        ("idx_creatures_weight",),
+    ]
+
+
+@pytest.fixture
+def csv_folder(tmpdir):
+    for i in range(3):
+        (tmpdir / "part{}.csv".format(i)).write(
+            "id,name\n"
+            + "".join("{},Name {}\n".format(i * 100 + j, j) for j in range(50))
+        )
+    (tmpdir / "extra.json").write('[{"id": 1000, "name": "JSON"}]')
+    return tmpdir
+
+
+@pytest.mark.asyncio
+async def test_import_csv_files_one_table_per_file(csv_folder):
+    db_path = str(csv_folder / "data.db")
+    db = sqlite3.connect(db_path)
+    db.execute("create table part0 (id integer)")
+    db.close()
+    datasette = Datasette([db_path], memory=True)
+    await datasette.invoke_startup()
+    paths = [str(csv_folder / "part{}.csv".format(i)) for i in range(3)] + [
+        str(csv_folder / "extra.json")
+    ]
+    response = await datasette.client.post(
+        "/-/import-csv-files",
+        json={"paths": paths, "database": "data", "batch_size": 20},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["ok"]
+    assert data["path"] == "/data"
+    assert data["rows"] == 151
+    assert data["rows_per_second"] > 0
+    assert data["files"] == [
+        {
+            "file": paths[0],
+            "ok": True,
+            "table": "part0_1",
+            "rows": 50,
+            "path": "/data/part0_1",
+        },
+        {
+            "file": paths[1],
+            "ok": True,
+            "table": "part1",
+            "rows": 50,
+            "path": "/data/part1",
+        },
+        {
+            "file": paths[2],
+            "ok": True,
+            "table": "part2",
+            "rows": 50,
+            "path": "/data/part2",
+        },
+        {
+            "file": paths[3],
+            "ok": True,
+            "table": "extra",
+            "rows": 1,
+            "path": "/data/extra",
+        },
+    ]
+    response2 = await datasette.client.get("/data/part2.json?_shape=array&_size=1")
+    assert response2.json() == [{"rowid": 1, "id": "200", "name": "Name 0"}]
+
+
+@pytest.mark.asyncio
+async def test_import_csv_files_into_one_table(csv_folder):
+    db_path = str(csv_folder / "data.db")
+    sqlite3.connect(db_path).execute("vacuum")
+    datasette = Datasette([db_path], memory=True)
+    await datasette.invoke_startup()
+    bad_path = str(csv_folder / "bad.json")
+    open(bad_path, "w").write("[{")
+    paths = [str(csv_folder / "part{}.csv".format(i)) for i in range(3)] + [bad_path]
+    response = await datasette.client.post(
+        "/-/import-csv-files",
+        json={"paths": paths, "database": "data", "table": "combined"},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["path"] == "/data/combined"
+    assert data["rows"] == 150
+    assert [f["ok"] for f in data["files"]] == [True, True, True, False]
+    assert data["files"][3]["error"].startswith("JSONDecodeError")
+    response2 = await datasette.client.get(
+        "/data.json?sql=select count(*), count(distinct id) from combined&_shape=array"
+    )
+    assert list(response2.json()[0].values()) == [150, 150]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "body,expected_error",
+    (
+        ({"database": "data"}, "'paths' must be a list of strings"),
+        (
+            {"paths": ["/does/not/exist.csv"], "database": "data"},
+            "File does not exist: /does/not/exist.csv",
+        ),
+        (
+            {"paths": "part0.csv", "database": "data"},
+            "'paths' must be a list of strings",
+        ),
+        ({"paths": "PATHS", "database": "missing"}, "Invalid database"),
+    ),
+)
+async def test_import_csv_files_errors(csv_folder, body, expected_error):
+    db_path = str(csv_folder / "data.db")
+    sqlite3.connect(db_path).execute("vacuum")
+    datasette = Datasette([db_path], memory=True)
+    await datasette.invoke_startup()
+    if body.get("paths") == "PATHS":
+        body["paths"] = [str(csv_folder / "part0.csv")]
+    response = await datasette.client.post(
+        "/-/import-csv-files",
+        json=body,
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 400
+    assert response.json() == {"ok": False, "error": expected_error}
+
+
+def _crashing_parse_file_worker(index, filepath, *args, **kwargs):
+    # Runs in the worker process, which dies as if it had been OOM killed
+    if "crash" in filepath:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return _parse_file_worker(index, filepath, *args, **kwargs)
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not hasattr(signal, "SIGKILL"), reason="Needs SIGKILL")
+async def test_import_csv_files_worker_dies(csv_folder):
+    db_path = str(csv_folder / "data.db")
+    sqlite3.connect(db_path).execute("vacuum")
+    datasette = Datasette([db_path], memory=True)
+    await datasette.invoke_startup()
+    crash_path = str(csv_folder / "crash.csv")
+    open(crash_path, "w").write("id,name\n1,Crash\n")
+    with mock.patch(
+        "datasette_app_support.importer._parse_file_worker",
+        _crashing_parse_file_worker,
+    ):
+        response = await asyncio.wait_for(
+            datasette.client.post(
+                "/-/import-csv-files",
+                json={"paths": [crash_path], "database": "data"},
+                headers={"Authorization": "Bearer fake-token"},
+            ),
+            timeout=30,
+        )
+    assert response.status_code == 200
+    (result,) = response.json()["files"]
+    assert not result["ok"]
+    assert result["error"].startswith("BrokenProcessPool")
+    # The broken pool is replaced for the next import
+    response2 = await datasette.client.post(
+        "/-/import-csv-files",
+        json={"paths": [str(csv_folder / "part0.csv")], "database": "data"},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response2.json()["rows"] == 50
+
+
+@pytest.mark.asyncio
+async def test_import_csv_files_starts_workers_off_the_event_loop(csv_folder):
+    db_path = str(csv_folder / "data.db")
+    sqlite3.connect(db_path).execute("vacuum")
+    datasette = Datasette([db_path], memory=True)
+    await datasette.invoke_startup()
+    threads = []
+
+    def recording_parse_processes():
+        threads.append(threading.current_thread())
+        return parse_processes()
+
+    with mock.patch(
+        "datasette_app_support.importer.parse_processes", recording_parse_processes
+    ):
+        response = await datasette.client.post(
+            "/-/import-csv-files",
+            json={"paths": [str(csv_folder / "part0.csv")], "database": "data"},
+            headers={"Authorization": "Bearer fake-token"},
+        )
+    assert response.json()["rows"] == 50
+    # Starting the manager and pool blocks, so must not stall other requests
+    assert threads and threading.main_thread() not in threads
+
+
+@pytest.mark.asyncio
+async def test_import_csv_files_fast_into_existing_table(tmpdir):
+    db_path = str(tmpdir / "data.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("create table demo (id integer, name text)")
+    conn.execute("create index demo_name on demo (name)")
+    conn.execute("create unique index demo_id on demo (id)")
+    conn.execute("insert into demo values (0, 'Existing')")
+    conn.commit()
+    conn.close()
+    datasette = Datasette([db_path], memory=True)
+    await datasette.invoke_startup()
+    db = datasette.get_database("data")
+    path = str(tmpdir / "demo.csv")
+    open(path, "w").write(
+        "id,name\n" + "".join("{},Name {}\n".format(i, i) for i in range(1, 251))
+    )
+    response = await datasette.client.post(
+        "/-/import-csv-files",
+        json={
+            "paths": [path],
+            "database": "data",
+            "table": "demo",
+            "fast": True,
+            "batch_size": 100,
+        },
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    assert response.json()["rows"] == 250
+    # Indexes were put back and the connection settings were restored
+    indexes = (
+        await db.execute(
+            "select name from sqlite_master where type = 'index' order by name"
+        )
+    ).rows
+    assert [r[0] for r in indexes] == ["demo_id", "demo_name"]
+    assert (
+        await db.execute_write_fn(
+            lambda conn: conn.execute("pragma synchronous").fetchone()[0], block=True
+        )
+    ) == 2
+
+    # A failed fast import removes the rows it added
+    open(path, "w").write(
+        "id,name\n"
+        + "".join("{},Name {}\n".format(i, i) for i in range(300, 550))
+        # Clashes with the unique index, partway through
+        + "1,Duplicate\n"
+    )
+    response2 = await datasette.client.post(
+        "/-/import-csv-files",
+        json={
+            "paths": [path],
+            "database": "data",
+            "table": "demo",
+            "fast": True,
+            "batch_size": 100,
+        },
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response2.status_code == 500
+    assert (await db.execute("select count(*) from demo")).single_value() == 251
+    assert (await db.table_names()) == ["demo"]
+
+
+class _InterruptedStream(httpx.AsyncByteStream):
+    def __init__(self, data, fail_after):
+        self.data = data
+        self.fail_after = fail_after
+
+    async def __aiter__(self):
+        for i in range(0, self.fail_after, 4096):
+            yield self.data[i : min(i + 4096, self.fail_after)]
+        raise httpx.ReadError("Connection lost")
+
+
+@pytest.mark.asyncio
+async def test_import_csv_url_resume(httpx_mock):
+    data = b"id,name\n" + b"".join(
+        "{},Name {}\n".format(i, i).encode("utf-8") for i in range(25000)
+    )
+    requests = []
+
+    def respond(request):
+        requests.append(request)
+        headers = {"etag": '"v1"', "content-type": "text/csv"}
+        range_header = request.headers.get("range")
+        if range_header:
+            assert request.headers["if-range"] == '"v1"'
+            start = int(range_header.split("=")[1].rstrip("-"))
+            headers["content-range"] = "bytes {}-{}/{}".format(
+                start, len(data) - 1, len(data)
+            )
+            return httpx.Response(206, headers=headers, content=data[start:])
+        if len(requests) == 1:
+            return httpx.Response(
+                200,
+                headers=headers,
+                stream=_InterruptedStream(data, int(len(data) * 0.7)),
+            )
+        return httpx.Response(200, headers=headers, content=data)
+
+    httpx_mock.add_callback(respond, url="http://example.com/big.csv")
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    await _reset_temporary(datasette)
+    body = {"url": "http://example.com/big.csv"}
+    response = await datasette.client.post(
+        "/-/open-csv-from-url",
+        json=body,
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 500
+    assert response.json()["error"] == "Connection lost"
+    db = datasette.get_database("temporary")
+    state = await url_import_state(db, "http://example.com/big.csv")
+    assert state["status"] == "partial"
+
+    # Importing again carries on from the last batch that was written
+    response2 = await datasette.client.post(
+        "/-/open-csv-from-url",
+        json=body,
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response2.status_code == 200
+    assert _without_throughput(response2.json()) == {
+        "ok": True,
+        "path": "/temporary/big",
+        "rows": 25000,
+        "resumed": True,
+    }
+    assert requests[1].headers["range"].startswith("bytes=")
+    assert (
+        await db.execute("select count(*), count(distinct id), max(rowid) from big")
+    ).rows[0][:] == (25000, 25000, 25000)
+
+    # An unchanged file is not imported again
+    def not_modified(request):
+        assert request.headers["if-none-match"] == '"v1"'
+        return httpx.Response(304)
+
+    httpx_mock.reset(False)
+    httpx_mock.add_callback(not_modified, url="http://example.com/big.csv")
+    response3 = await datasette.client.post(
+        "/-/open-csv-from-url",
+        json=body,
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert _without_throughput(response3.json()) == {
+        "ok": True,
+        "path": "/temporary/big",
+        "rows": 25000,
+        "unchanged": True,
+    }
+    assert "big_1" not in await db.table_names()
+
+
+@pytest.mark.asyncio
+async def test_import_csv_url_interrupted_gzip(httpx_mock):
+    data = gzip.compress(
+        b"id,name\n"
+        + b"".join("{},Name {}\n".format(i, i).encode("utf-8") for i in range(25000))
+    )
+    httpx_mock.add_response(
+        url="http://example.com/big.csv.gz",
+        headers={"etag": '"v1"'},
+        stream=_InterruptedStream(data, int(len(data) * 0.7)),
+    )
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    await _reset_temporary(datasette)
+    db = datasette.get_database("temporary")
+    body = {"url": "http://example.com/big.csv.gz", "batch_size": 1000}
+    response = await datasette.client.post(
+        "/-/open-csv-from-url",
+        json=body,
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 500
+    assert 0 < (await db.execute("select count(*) from big")).single_value() < 25000
+    # Decompressed offsets cannot be resumed, but the table is still recorded
+    state = await url_import_state(db, "http://example.com/big.csv.gz")
+    assert state["status"] == "partial"
+    assert state["bytes_offset"] is None
+
+    # Importing again starts from the beginning, in the same table
+    httpx_mock.add_response(
+        url="http://example.com/big.csv.gz", headers={"etag": '"v1"'}, content=data
+    )
+    response2 = await datasette.client.post(
+        "/-/open-csv-from-url",
+        json=body,
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert _without_throughput(response2.json()) == {
+        "ok": True,
+        "path": "/temporary/big",
+        "rows": 25000,
+    }
+    assert "range" not in httpx_mock.get_requests()[-1].headers
+    assert (await db.execute("select count(*), count(distinct id) from big")).rows[0][
+        :
+    ] == (25000, 25000)
+    assert "big_1" not in await db.table_names()
+
+
+@pytest.mark.asyncio
+async def test_import_csv_url_content_hash(httpx_mock):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    await _reset_temporary(datasette)
+    db = datasette.get_database("temporary")
+
+    async def import_url(**options):
+        response = await datasette.client.post(
+            "/-/open-csv-from-url",
+            json=dict(options, url="http://example.com/pets.csv"),
+            headers={"Authorization": "Bearer fake-token"},
+        )
+        assert response.status_code == 200
+        return _without_throughput(response.json())
+
+    # No etag or last-modified, so the content hash is used instead
+    httpx_mock.add_response(
+        url="http://example.com/pets.csv", text="id,name\n1,Cleo\n2,Pancakes"
+    )
+    assert await import_url() == {"ok": True, "path": "/temporary/pets", "rows": 2}
+    # The download is hashed before any rows are written
+    with mock.patch("datasette_app_support.utils.write_rows_to_table") as write:
+        assert await import_url() == {
+            "ok": True,
+            "path": "/temporary/pets",
+            "rows": 2,
+            "unchanged": True,
+        }
+    assert not write.called
+    # A changed file replaces the rows in the same table
+    httpx_mock.reset(False)
+    httpx_mock.add_response(
+        url="http://example.com/pets.csv",
+        text="id,name,species\n3,Azi,cat\n4,Cleo,dog\n5,Pancakes,dog\n6,Tom,cat",
+    )
+    assert await import_url(create_indexes=True) == {
+        "ok": True,
+        "path": "/temporary/pets",
+        "rows": 4,
+        # Named after the table the rows ended up in, not the one they
+        # were imported into before it replaced the old table
+        "indexes": ["idx_pets_species"],
+    }
+    assert [r["name"] for r in await db.execute("select name from pets")] == [
+        "Azi",
+        "Cleo",
+        "Pancakes",
+        "Tom",
+    ]
+    assert [
+        r["name"]
+        for r in await db.execute(
+            "select name from sqlite_master where type = 'index' and tbl_name = 'pets'"
+        )
+    ] == ["idx_pets_species"]
+    # The import state is not kept in the database itself - sqlite_stat1 is
+    # from the ANALYZE run after creating the index
+    assert sorted(await db.table_names()) == ["pets", "sqlite_stat1"]
+
+
+@pytest.mark.asyncio
+async def test_import_csv_url_same_last_modified(httpx_mock):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    await _reset_temporary(datasette)
+    headers = {"last-modified": "Wed, 21 Oct 2026 07:28:00 GMT"}
+    # This server ignores If-Modified-Since and sends the whole file again
+    for _ in range(2):
+        httpx_mock.add_response(
+            url="http://example.com/dogs.csv",
+            text="id,name\n1,Cleo\n2,Pancakes",
+            headers=headers,
+        )
+
+    async def import_url():
+        response = await datasette.client.post(
+            "/-/open-csv-from-url",
+            json={"url": "http://example.com/dogs.csv"},
+            headers={"Authorization": "Bearer fake-token"},
+        )
+        return _without_throughput(response.json())
+
+    assert await import_url() == {"ok": True, "path": "/temporary/dogs", "rows": 2}
+    with mock.patch("datasette_app_support.utils.AsyncCSVReader") as reader:
+        assert await import_url() == {
+            "ok": True,
+            "path": "/temporary/dogs",
+            "rows": 2,
+            "unchanged": True,
+        }
+    assert not reader.called
+    requests = httpx_mock.get_requests(url="http://example.com/dogs.csv")
+    assert requests[1].headers["if-modified-since"] == headers["last-modified"]
@@ -1,4 +1,9 @@
 from datasette.app import Datasette
+from datasette_app_support.databases import probe_sqlite_file
+from unittest import mock
+import collections
+import os
+import pathlib
 import pytest
 import sqlite3
 
@@ -16,7 +21,24 @@ async def test_open_database_files(tmpdir):
         headers={"Authorization": "Bearer fake-token"},
     )
     assert response.status_code == 200
-    assert response.json() == {"ok": True, "path": "/test"}
+    assert response.json() == {
+        "ok": True,
+        "path": "/test",
+        "file_info": {
+            "size": 8192,
+            "page_size": 4096,
+            "page_count": 2,
+            "journal_mode": "rollback",
+            "schema_version": 1,
+            "encoding": "utf-8",
+            "user_version": 0,
+            "application_id": 0,
+            "sqlite_version": sqlite3.sqlite_version,
+            "tables": 1,
+            "views": 0,
+            "indexes": 0,
+        },
+    }
     response = await datasette.client.get("/test.json")
     assert (
         response.json()["tables"][0].items()
@@ -51,3 +73,280 @@ async def test_open_database_files_invalid(file, tmpdir):
     )
     assert response.status_code == 400
     assert response.json()["ok"] is False
+
+
+@pytest.mark.asyncio
+async def test_open_database_file_hard_link(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    path = str(tmpdir / "linked.db")
+    sqlite3.connect(path).execute("vacuum")
+    link_path = str(tmpdir / "link-to-linked.db")
+    os.link(path, link_path)
+    response = await datasette.client.post(
+        "/-/open-database-file",
+        json={"path": path},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    response2 = await datasette.client.post(
+        "/-/open-database-file",
+        json={"path": link_path},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response2.status_code == 400
+    assert response2.json() == {"error": "That file is already open", "ok": False}
+
+
+@pytest.mark.asyncio
+async def test_open_database_paths(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    path = str(tmpdir / "registered.db")
+    sqlite3.connect(path).execute("vacuum")
+    response = await datasette.client.post(
+        "/-/open-database-file",
+        json={"path": path},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    response2 = await datasette.client.get(
+        "/-/open-database-paths", headers={"Authorization": "Bearer fake-token"}
+    )
+    assert response2.json() == {
+        "ok": True,
+        "databases": [
+            {
+                "name": "registered",
+                "path": path,
+                "resolved_path": str(pathlib.Path(path).resolve()),
+                "device": os.stat(path).st_dev,
+                "inode": os.stat(path).st_ino,
+            }
+        ],
+    }
+    # Removed databases drop out of the registry and can be opened again
+    datasette.remove_database("registered")
+    response3 = await datasette.client.get(
+        "/-/open-database-paths", headers={"Authorization": "Bearer fake-token"}
+    )
+    assert response3.json() == {"ok": True, "databases": []}
+    response4 = await datasette.client.post(
+        "/-/open-database-file",
+        json={"path": path},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response4.status_code == 200
+    # Requires authentication
+    response5 = await datasette.client.get("/-/open-database-paths")
+    assert response5.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_open_database_files_directory(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    folder = tmpdir / "folder"
+    folder.mkdir()
+    for name in ("one", "two", "three"):
+        sqlite3.connect(str(folder / "{}.db".format(name))).execute(
+            "create table t (id integer primary key)"
+        )
+    open(str(folder / "broken.db"), "w").write("not a database")
+    open(str(folder / "notes.txt"), "w").write("ignored")
+    # Open one of them first
+    response = await datasette.client.post(
+        "/-/open-database-file",
+        json={"path": str(folder / "two.db")},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    response2 = await datasette.client.post(
+        "/-/open-database-files",
+        json={"directory": str(folder)},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response2.status_code == 200
+    results = response2.json()["databases"]
+    for result in results:
+        if result["ok"]:
+            assert result.pop("file_info")["tables"] == 1
+    assert results == [
+        {
+            "file": str(folder / "broken.db"),
+            "ok": False,
+            "error": "Not a valid SQLite database",
+        },
+        {"file": str(folder / "one.db"), "ok": True, "path": "/one"},
+        {"file": str(folder / "three.db"), "ok": True, "path": "/three"},
+        {
+            "file": str(folder / "two.db"),
+            "ok": False,
+            "error": "That file is already open",
+        },
+    ]
+    assert {"one", "two", "three"}.issubset(datasette.databases)
+
+
+@pytest.mark.asyncio
+async def test_open_database_files_paths(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    path = str(tmpdir / "listed.db")
+    sqlite3.connect(path).execute("vacuum")
+    missing = str(tmpdir / "missing.db")
+    response = await datasette.client.post(
+        "/-/open-database-files",
+        json={"paths": [path, missing, path]},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    results = response.json()["databases"]
+    assert results[0].pop("file_info")["tables"] == 0
+    assert response.json()["ok"] is True
+    assert results == [
+        {"file": path, "ok": True, "path": "/listed"},
+        {"file": missing, "ok": False, "error": "'path' does not exist"},
+        {"file": path, "ok": False, "error": "That file is already open"},
+    ]
+    response2 = await datasette.client.post(
+        "/-/open-database-files",
+        json={},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response2.status_code == 400
+    assert response2.json() == {
+        "ok": False,
+        "error": "'paths' or 'directory' key is required",
+    }
+
+
+def test_probe_sqlite_file(tmpdir):
+    path = str(tmpdir / "probe.db")
+    conn = sqlite3.connect(path)
+    conn.execute("pragma page_size = 8192")
+    conn.execute("pragma journal_mode = wal")
+    conn.execute("pragma user_version = 3")
+    conn.execute("create table one (id integer primary key, name text)")
+    conn.execute("create index idx_name on one(name)")
+    conn.execute("create view v as select * from one")
+    conn.commit()
+    conn.close()
+    error, info = probe_sqlite_file(path)
+    assert error is None
+    assert (
+        info.items()
+        >= {
+            "page_size": 8192,
+            "journal_mode": "wal",
+            "user_version": 3,
+            "tables": 1,
+            "views": 1,
+            "indexes": 1,
+        }.items()
+    )
+    # Results are cached until the file changes
+    with mock.patch("datasette_app_support.databases._probe") as probe:
+        assert probe_sqlite_file(path) == (None, info)
+        assert not probe.called
+    # Empty files are valid, empty databases
+    empty = str(tmpdir / "empty.db")
+    open(empty, "w").close()
+    assert probe_sqlite_file(empty) == (
+        None,
+        {
+            "size": 0,
+            "page_size": None,
+            "page_count": 0,
+            "tables": 0,
+            "views": 0,
+            "indexes": 0,
+        },
+    )
+    # Files without the SQLite header are rejected without connecting
+    invalid = str(tmpdir / "invalid.db")
+    open(invalid, "w").write("x" * 200)
+    with mock.patch("datasette_app_support.databases.sqlite3.connect") as connect:
+        assert probe_sqlite_file(invalid) == ("Not a valid SQLite database", None)
+        assert not connect.called
+
+
+def test_probe_sqlite_file_cache_is_locked(tmpdir):
+    # attach_database_files() probes from several threads at once, so every
+    # read and write of the shared cache must hold its lock
+    from datasette_app_support import databases
+
+    class CheckedCache(collections.OrderedDict):
+        def _check(self):
+            assert databases._probe_cache_lock.locked()
+
+        def __contains__(self, key):
+            self._check()
+            return super().__contains__(key)
+
+        def __getitem__(self, key):
+            self._check()
+            return super().__getitem__(key)
+
+        def __setitem__(self, key, value):
+            self._check()
+            super().__setitem__(key, value)
+
+        def get(self, key, default=None):
+            self._check()
+            return super().get(key, default)
+
+        def move_to_end(self, key, last=True):
+            self._check()
+            super().move_to_end(key, last)
+
+        def popitem(self, last=True):
+            self._check()
+            return super().popitem(last)
+
+    paths = []
+    for i in range(3):
+        path = str(tmpdir / "probe{}.db".format(i))
+        sqlite3.connect(path).execute("create table t (id integer)")
+        paths.append(path)
+    with mock.patch.object(databases, "_probe_cache", CheckedCache()), mock.patch(
+        "datasette_app_support.databases.PROBE_CACHE_SIZE", 2
+    ):
+        for path in paths * 2:
+            error, info = probe_sqlite_file(path)
+            assert error is None and info["tables"] == 1
+
+
+@pytest.mark.asyncio
+async def test_open_database_file_profile(tmpdir):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    path = str(tmpdir / "profiled.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    response = await datasette.client.post(
+        "/-/open-database-file",
+        json={"path": path, "profile": "read-heavy"},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 200
+    db = datasette.get_database("profiled")
+    assert (await db.execute("pragma journal_mode")).single_value() == "wal"
+    assert (await db.execute("pragma mmap_size")).single_value() == 256 * 1024 * 1024
+    assert (await db.execute("pragma cache_size")).single_value() == -64 * 1024
+    response2 = await datasette.client.get(
+        "/-/database-profiles", headers={"Authorization": "Bearer fake-token"}
+    )
+    data = response2.json()
+    assert set(data["profiles"]) == {"default", "read-heavy", "import-heavy"}
+    assert data["profiles"]["read-heavy"]["database"] == {"journal_mode": "wal"}
+    assert data["databases"] == {"profiled": "read-heavy"}
+    # Unknown profiles are rejected
+    response3 = await datasette.client.post(
+        "/-/open-database-file",
+        json={"path": path, "profile": "turbo"},
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response3.status_code == 400
+    assert response3.json() == {
+        "ok": False,
+        "error": "profile must be one of: default, import-heavy, read-heavy",
+    }
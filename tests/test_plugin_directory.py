@@ -1,12 +1,18 @@
 from datasette.app import Datasette
+from datasette_app_support.plugin_directory import write_plugins
+from unittest import mock
 import httpx
+import json
+import os
 import pytest
+import sqlite_utils
 
 
 @pytest.mark.asyncio
 async def test_plugin_directory():
     datasette = Datasette([], memory=True)
     await datasette.invoke_startup()
+    await datasette._app_support_plugin_directory_refresh
     plugins = (
         await datasette.get_database("plugin_directory").execute(
             "select * from plugins"
@@ -31,6 +37,7 @@ async def test_plugin_directory():
         "installed_version": None,
         "upgrade": None,
         "is_default": 0,
+        "latest_release_display": "11th September 2021",
     }
     response = await datasette.client.get("/plugin_directory/plugins")
     assert "<h2>datasette-write</h2>" in response.text
@@ -52,6 +59,204 @@ async def test_plugin_directory_no_connection(httpx_mock):
 
     datasette = Datasette([], memory=True)
     await datasette.invoke_startup()
+    await datasette._app_support_plugin_directory_refresh
     response = await datasette.client.get("/plugin_directory/plugins")
     assert "<strong>Could not access plugins</strong>" in response.text
     assert '<label for="_search">Search:</label>' not in response.text
+
+
+@pytest.mark.asyncio
+async def test_plugin_directory_cache(httpx_mock, tmpdir):
+    cache_path = str(tmpdir / "plugins-cache.json")
+    with mock.patch.dict(os.environ, {"DATASETTE_PLUGIN_DIRECTORY_CACHE": cache_path}):
+        datasette = Datasette([], memory=True)
+        await datasette.invoke_startup()
+        assert await datasette._app_support_plugin_directory_refresh is True
+        cache = json.load(open(cache_path))
+        assert cache["plugins"][0]["name"] == "datasette-write"
+        # Simulate an ETag so the next launch sends a conditional request
+        cache["etag"] = '"abc"'
+        json.dump(cache, open(cache_path, "w"))
+
+        # Next launch is served from the cache while offline
+        httpx_mock.reset(False)
+
+        def raise_timeout(request):
+            assert request.headers["if-none-match"] == '"abc"'
+            raise httpx.NetworkError("No internet connection", request=request)
+
+        httpx_mock.add_callback(raise_timeout)
+        datasette2 = Datasette([], memory=True)
+        await datasette2.invoke_startup()
+        # Plugins are available before the refresh has completed
+        plugins = (
+            await datasette2.get_database("plugin_directory").execute(
+                "select name, installed from plugins"
+            )
+        ).rows
+        assert [dict(r) for r in plugins] == [
+            {"name": "datasette-write", "installed": "not installed"}
+        ]
+        assert await datasette2._app_support_plugin_directory_refresh is False
+
+
+@pytest.mark.asyncio
+async def test_plugin_directory_default_cache_path(tmpdir):
+    environ = dict(os.environ, XDG_CACHE_HOME=str(tmpdir))
+    environ.pop("DATASETTE_PLUGIN_DIRECTORY_CACHE")
+    with mock.patch.dict(os.environ, environ, clear=True), mock.patch(
+        "sys.platform", "linux"
+    ):
+        datasette = Datasette([], memory=True)
+        await datasette.invoke_startup()
+        assert await datasette._app_support_plugin_directory_refresh is True
+    cache = json.load(open(tmpdir / "datasette-app-support" / "plugin-directory.json"))
+    assert cache["plugins"][0]["name"] == "datasette-write"
+
+
+@pytest.mark.asyncio
+async def test_plugin_directory_not_modified(httpx_mock, tmpdir):
+    cache_path = str(tmpdir / "plugins-cache.json")
+    json.dump(
+        {
+            "etag": '"abc"',
+            "hash": "x",
+            "plugins": [
+                {"name": "datasette-cached", "full_name": "x/datasette-cached"}
+            ],
+        },
+        open(cache_path, "w"),
+    )
+    httpx_mock.reset(False)
+    httpx_mock.add_response(status_code=304)
+    with mock.patch.dict(os.environ, {"DATASETTE_PLUGIN_DIRECTORY_CACHE": cache_path}):
+        datasette = Datasette([], memory=True)
+        await datasette.invoke_startup()
+        assert await datasette._app_support_plugin_directory_refresh is False
+    plugins = (
+        await datasette.get_database("plugin_directory").execute(
+            "select name from plugins"
+        )
+    ).rows
+    assert [r["name"] for r in plugins] == ["datasette-cached"]
+
+
+@pytest.mark.asyncio
+async def test_write_plugins_incremental():
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    await datasette._app_support_plugin_directory_refresh
+    db = datasette.get_database("plugin_directory")
+    plugins = [
+        {
+            "name": "datasette-one",
+            "full_name": "a/datasette-one",
+            "description": "Alpha",
+        },
+        {
+            "name": "datasette-two",
+            "full_name": "a/datasette-two",
+            "description": "Beta",
+        },
+    ]
+    await write_plugins(datasette, plugins)
+    await write_plugins(
+        datasette,
+        [
+            dict(plugins[0], description="Now with maps"),
+            {
+                "name": "datasette-three",
+                "full_name": "a/datasette-three",
+                "description": "Gamma",
+            },
+        ],
+    )
+
+    async def search(q):
+        return [
+            r[0]
+            for r in await db.execute(
+                "select name from plugins where rowid in "
+                "(select rowid from plugins_fts where plugins_fts match ?) "
+                "order by name",
+                [q],
+            )
+        ]
+
+    assert [r[0] for r in await db.execute("select name from plugins")] == [
+        "datasette-one",
+        "datasette-three",
+    ]
+    # The search index followed the updates and deletes
+    assert await search("maps") == ["datasette-one"]
+    assert await search("Alpha") == []
+    assert await search("Beta") == []
+    assert await search("Gamma") == ["datasette-three"]
+    assert await search("datasette") == ["datasette-one", "datasette-three"]
+    indexed = await db.execute_fn(
+        lambda conn: [
+            index.columns for index in sqlite_utils.Database(conn)["plugins"].indexes
+        ]
+    )
+    for column in (
+        "stargazers_count",
+        "downloads_this_week",
+        "latest_release_at",
+        "installed",
+        "upgrade",
+    ):
+        assert [column] in indexed
+    facet_counts = await db.execute(
+        "select facet, value, count from plugin_facet_counts"
+    )
+    assert [tuple(r) for r in facet_counts] == [("installed", "not installed", 2)]
+
+
+@pytest.mark.asyncio
+async def test_plugin_directory_facet_counts():
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    await datasette._app_support_plugin_directory_refresh
+    released = {"tag_name": "0.1", "latest_release_at": "2021-09-11T05:59:43Z"}
+    await write_plugins(
+        datasette,
+        [
+            dict(
+                released,
+                name="datasette-app-support",
+                full_name="simonw/datasette-app-support",
+                tag_name="999.0",
+            ),
+            dict(released, name="datasette-one", full_name="a/datasette-one"),
+            dict(released, name="datasette-two", full_name="a/datasette-two"),
+        ],
+    )
+    response = await datasette.client.get("/plugin_directory/plugins")
+    # The precomputed counts are shown, without Datasette's own facets
+    assert '<div class="facet-results">' not in response.text
+    assert (
+        '<li><a href="/plugin_directory/plugins?installed=not+installed">'
+        "not installed</a> 2</li>"
+    ) in response.text
+    assert (
+        '<li><a href="/plugin_directory/plugins?installed=installed">'
+        "installed</a> 1</li>"
+    ) in response.text
+    assert (
+        '<li><a href="/plugin_directory/plugins?upgrade=upgrade+available">'
+        "upgrade available</a> 1</li>"
+    ) in response.text
+    # The selected value links back to the unfiltered directory
+    response = await datasette.client.get(
+        "/plugin_directory/plugins?installed=installed"
+    )
+    assert (
+        '<li>installed &middot; 1 <a href="/plugin_directory/plugins" class="cross">'
+    ) in response.text
+    # No upgrade facet when there is nothing to upgrade
+    await write_plugins(
+        datasette, [dict(released, name="datasette-one", full_name="a/datasette-one")]
+    )
+    response = await datasette.client.get("/plugin_directory/plugins")
+    assert 'id="plugin-facet-installed"' in response.text
+    assert 'id="plugin-facet-upgrade"' not in response.text
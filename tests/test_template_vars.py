@@ -0,0 +1,97 @@
+from datasette.app import Datasette
+from datasette_app_support.plugin_directory import write_plugins
+from datasette_app_support.template_vars import (
+    TEMPLATE_VARS,
+    invalidate_template_vars,
+    register_template_var,
+    template_vars,
+)
+import pytest
+
+
+@pytest.fixture
+def counter_var():
+    calls = []
+
+    @register_template_var("test_counter", templates=("index.html",))
+    async def test_counter(datasette):
+        calls.append(1)
+        return len(calls)
+
+    yield calls
+    TEMPLATE_VARS.pop("test_counter")
+
+
+@pytest.mark.asyncio
+async def test_template_vars_are_cached(counter_var):
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    await datasette._app_support_plugin_directory_refresh
+    assert (await template_vars(datasette, "index.html"))["test_counter"] == 1
+    assert (await template_vars(datasette, "index.html"))["test_counter"] == 1
+    # Only provided for the templates it was registered for
+    assert "test_counter" not in await template_vars(datasette, "database.html")
+    invalidate_template_vars(datasette, "test_counter")
+    assert (await template_vars(datasette, "index.html"))["test_counter"] == 2
+    assert len(counter_var) == 2
+
+
+@pytest.mark.asyncio
+async def test_template_var_invalidated_while_computing():
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    await datasette._app_support_plugin_directory_refresh
+    calls = []
+
+    @register_template_var("test_racy", templates=("index.html",))
+    async def test_racy(datasette):
+        calls.append(1)
+        if len(calls) == 1:
+            # The data changes while the first value is being computed
+            invalidate_template_vars(datasette, "test_racy")
+        return len(calls)
+
+    try:
+        assert (await template_vars(datasette, "index.html"))["test_racy"] == 1
+        # That value was not cached, as it may already be out of date
+        assert (await template_vars(datasette, "index.html"))["test_racy"] == 2
+        assert (await template_vars(datasette, "index.html"))["test_racy"] == 2
+    finally:
+        TEMPLATE_VARS.pop("test_racy")
+
+
+@pytest.mark.asyncio
+async def test_total_plugin_count_invalidated_by_write_plugins():
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    await datasette._app_support_plugin_directory_refresh
+    db = datasette.get_database("plugin_directory")
+    assert (await template_vars(datasette, "table.html"))["total_plugin_count"] == 1
+    # Writing to the table directly does not change the cached value
+    await db.execute_write("delete from plugins", block=True)
+    assert (await template_vars(datasette, "table.html"))["total_plugin_count"] == 1
+    await write_plugins(
+        datasette,
+        [
+            {"name": "datasette-one", "full_name": "a/datasette-one"},
+            {"name": "datasette-two", "full_name": "a/datasette-two"},
+        ],
+    )
+    assert (await template_vars(datasette, "table.html"))["total_plugin_count"] == 2
+
+
+@pytest.mark.asyncio
+async def test_index_shows_plugin_upgrades():
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    await datasette._app_support_plugin_directory_refresh
+    response = await datasette.client.get("/")
+    assert "plugin upgrade" not in response.text
+    installed = {p["name"]: p["version"] for p in datasette._plugins()}
+    name = sorted(installed)[0]
+    await write_plugins(
+        datasette,
+        [{"name": name, "full_name": "a/" + name, "tag_name": "999.0"}],
+    )
+    response2 = await datasette.client.get("/")
+    assert "1 plugin upgrade available" in response2.text
@@ -0,0 +1,190 @@
+from datasette.app import Datasette
+from datasette_app_support.charsets import DETECT_ENCODING_SAMPLE, TextDecoder
+from datasette_app_support.utils import (
+    AsyncCSVReader,
+    next_free_table_name,
+    release_table_names,
+    reserve_table_name,
+)
+import asyncio
+import importlib.util
+import pathlib
+import pytest
+import sqlite3
+import time
+
+
+async def _chunks(data, size):
+    for i in range(0, len(data), size):
+        yield data[i : i + size]
+
+
+async def _read_all(data, size):
+    rows = []
+    async for batch in AsyncCSVReader(_chunks(data, size)):
+        assert batch
+        rows.extend(batch)
+    return rows
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", (1, 2, 3, 7, 1000))
+async def test_async_csv_reader(size):
+    data = (
+        b"id,name,notes\r\n"
+        b'1,Cleo,"Multiple\nlines, with ""quotes"""\r\n'
+        b"2,S\xc3\xa3o Paulo,\r\n"
+        b"\r\n"
+        b'3,"Pancakes",short'
+    )
+    assert await _read_all(data, size) == [
+        {"id": "1", "name": "Cleo", "notes": 'Multiple\nlines, with "quotes"'},
+        {"id": "2", "name": "São Paulo", "notes": ""},
+        {"id": "3", "name": "Pancakes", "notes": "short"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_async_csv_reader_literal_quote_in_unquoted_field():
+    data = b"name,height\nCleo,5'10\"\n" + b"".join(
+        b'Dog %d,"1\'%d"""\n' % (i, i) for i in range(10)
+    )
+    batches = [
+        batch async for batch in AsyncCSVReader(_chunks(data, 16), encoding="utf-8")
+    ]
+    # Records after the stray quote are still yielded as they arrive
+    assert len(batches) > 2
+    rows = [row for batch in batches for row in batch]
+    assert rows[0] == {"name": "Cleo", "height": "5'10\""}
+    assert rows[1:] == [
+        {"name": "Dog %d" % i, "height": "1'%d\"" % i} for i in range(10)
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", (1, 12, 1000))
+async def test_async_csv_reader_newline_in_field_closed_mid_value(size):
+    # The csv module ends the quoted part at y" and carries on with the value
+    data = b'a,b\n1,"x\ny"z\n2,"\n"\n'
+    rows = [
+        row
+        async for batch in AsyncCSVReader(_chunks(data, size), encoding="utf-8")
+        for row in batch
+    ]
+    assert rows == [
+        {"a": "1", "b": "x\nyz"},
+        {"a": "2", "b": "\n"},
+    ]
+
+
+def _load_benchmark():
+    path = pathlib.Path(__file__).parent.parent / "benchmarks" / "async_csv_reader.py"
+    spec = importlib.util.spec_from_file_location("async_csv_reader", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_async_csv_reader_not_slower_than_async_dict_reader():
+    benchmark = _load_benchmark()
+    data = benchmark.make_csv(20000)
+    runs = {
+        "old": lambda: benchmark.run_old(data),
+        "new": lambda: benchmark.run_new(data, 65536),
+    }
+    # Best of several alternating runs, so a busy machine - or the rest of
+    # the suite's background work - does not cause a failure
+    best = {}
+    for _ in range(7):
+        for name, coro_fn in runs.items():
+            start = time.perf_counter()
+            assert asyncio.run(coro_fn()) == 20000
+            elapsed = time.perf_counter() - start
+            best[name] = min(best.get(name, elapsed), elapsed)
+    assert best["new"] <= best["old"]
+
+
+@pytest.mark.asyncio
+async def test_async_csv_reader_bom_and_missing_fields():
+    data = b"\xef\xbb\xbfid,name\n1\n"
+    assert await _read_all(data, 4) == [{"id": "1", "name": None}]
+
+
+@pytest.mark.asyncio
+async def test_async_csv_reader_too_many_fields():
+    with pytest.raises(ValueError) as e:
+        await _read_all(b"id,name\n1,Cleo,extra\n", 5)
+    assert str(e.value) == "Row 2 has 3 fields, expected 2"
+
+
+@pytest.mark.asyncio
+async def test_async_csv_reader_batches_per_chunk():
+    data = b"id\n" + b"".join(b"%d\n" % i for i in range(10))
+    batches = [
+        [row["id"] for row in batch]
+        async for batch in AsyncCSVReader(_chunks(data, 9), encoding="utf-8")
+    ]
+    assert batches == [["0", "1", "2"], ["3", "4", "5", "6"], ["7", "8", "9"]]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", (1, 5, 1000))
+@pytest.mark.parametrize(
+    "data",
+    (
+        # cp1252, detected from the first bytes
+        "id,name\n1,S\u00e3o Paulo\n2,\u20ac5\n".encode("cp1252"),
+        # UTF-16 with a byte order mark
+        "id,name\n1,S\u00e3o Paulo\n2,\u20ac5\n".encode("utf-16"),
+        # UTF-8 with a byte order mark
+        "\ufeffid,name\n1,S\u00e3o Paulo\n2,\u20ac5\n".encode("utf-8"),
+    ),
+)
+async def test_async_csv_reader_detects_encoding(data, size):
+    assert await _read_all(data, size) == [
+        {"id": "1", "name": "S\u00e3o Paulo"},
+        {"id": "2", "name": "\u20ac5"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_text_decoder_switches_to_cp1252():
+    decoder = TextDecoder()
+    # Valid UTF-8 for the whole of the sample, then a cp1252 byte
+    sample = "\u00e9".encode("utf-8") * (DETECT_ENCODING_SAMPLE // 2)
+    text = decoder.decode(sample) + decoder.decode(b"caf\xe9", final=True)
+    assert decoder.encoding == "cp1252"
+    assert decoder.switched
+    assert text == "\u00e9" * (DETECT_ENCODING_SAMPLE // 2) + "caf\u00e9"
+
+
+@pytest.mark.parametrize(
+    "existing,table_name,expected",
+    (
+        ([], "demo", "demo"),
+        (["demo"], "demo", "demo_1"),
+        (["Demo", "demo_1", "demo_2", "demo_4"], "demo", "demo_3"),
+        # Only names that start with the whole of the table name count
+        (["demo", "demoX1", "demo_other"], "demo", "demo_1"),
+        # Underscores and percent signs are not LIKE wildcards here
+        (["my_table", "myXtable_1", "my_table_1"], "my_table", "my_table_2"),
+        (["100%"], "100%", "100%_1"),
+    ),
+)
+def test_next_free_table_name(existing, table_name, expected):
+    conn = sqlite3.connect(":memory:")
+    for name in existing:
+        conn.execute("create table [{}] (id integer)".format(name))
+    assert next_free_table_name(conn, table_name) == expected
+
+
+@pytest.mark.asyncio
+async def test_reserve_table_name():
+    datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    db = datasette.add_memory_database("reserve_table_name")
+    await db.execute_write("create table demo (id integer)", block=True)
+    names = await asyncio.gather(*[reserve_table_name(db, "demo") for _ in range(5)])
+    assert sorted(names) == ["demo_1", "demo_2", "demo_3", "demo_4", "demo_5"]
+    release_table_names(db, "demo_2", "demo_3")
+    assert await reserve_table_name(db, "demo") == "demo_2"